@@ -0,0 +1,205 @@
+# нагрузочный тест /messages/connect: N пользователей в чатах по fanout участников,
+# каждый шлет rate сообщений в секунду с текстом payload байт.
+# Без --url поднимает benchmarks.stand в отдельном процессе.
+# запуск: python -m benchmarks.load --users 100 --fanout 2 --rate 2 --duration 10 > run.json
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+import httpx
+import websockets
+
+
+def percentile(values: list[float], q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))
+    return values[index]
+
+
+def round_or_none(value: float | None) -> float | None:
+    return round(value, 3) if value is not None else None
+
+
+# сумма счетчика prometheus по всем меткам
+def read_counter(text: str, name: str) -> float:
+    total = 0.0
+    for line in text.splitlines():
+        if line.startswith(name + '_total'):
+            total += float(line.rsplit(' ', 1)[1])
+    return total
+
+
+async def scrape(http_url: str) -> dict[str, float]:
+    async with httpx.AsyncClient() as client:
+        text = (await client.get(f'{http_url}/metrics')).text
+    return {
+        'messages': read_counter(text, 'ws_messages'),
+        'redis': read_counter(text, 'redis_round_trips'),
+        'mongo': read_counter(text, 'mongo_round_trips'),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.errors = 0
+        self.latencies: list[float] = []
+
+
+async def run_user(ws_url: str, user_id: int, chat_id: int, recipient_id: int, args,
+                   stats: Stats, started: asyncio.Event, stop: asyncio.Event) -> None:
+    url = (f'{ws_url}/messages/connect?chat_id={chat_id}&user_id={user_id}'
+           f'&recipient_id={recipient_id}&layer=1')
+    try:
+        async with websockets.connect(url, max_size=None) as ws:
+            async def receive():
+                async for frame in ws:
+                    if frame == 'PONG':
+                        continue
+                    message = json.loads(frame)['message']
+                    if message['user_id'] == user_id:
+                        continue
+                    sent_at = datetime.fromisoformat(message['sent_at'])
+                    stats.latencies.append(
+                        (datetime.now(timezone.utc) - sent_at).total_seconds())
+                    stats.delivered += 1
+
+            receiver = asyncio.create_task(receive())
+            await started.wait()
+            # разносим отправку пользователей по времени, чтобы не слать всё одним залпом
+            await asyncio.sleep(random.random() / args.rate)
+            text = 'x' * args.payload
+            while not stop.is_set():
+                await ws.send(json.dumps({
+                    'message': text,
+                    'sent_at': datetime.now(timezone.utc).isoformat()
+                }))
+                stats.sent += 1
+                await asyncio.sleep(1 / args.rate)
+
+            # ждем доставки последних сообщений
+            await asyncio.sleep(args.drain)
+            receiver.cancel()
+    except (OSError, websockets.exceptions.WebSocketException):
+        stats.errors += 1
+
+
+def wait_port(host: str, port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'Стенд не поднялся на {host}:{port}')
+
+
+async def run(args, http_url: str) -> dict:
+    ws_url = http_url.replace('http', 'ws', 1)
+    stats = Stats()
+    started, stop = asyncio.Event(), asyncio.Event()
+
+    # пользователи раскладываются по чатам по fanout человек
+    users = []
+    for user_id in range(1, args.users + 1):
+        chat_id = (user_id - 1) // args.fanout + 1
+        first = (chat_id - 1) * args.fanout + 1
+        recipient_id = first if user_id != first else min(first + 1, args.users)
+        users.append((user_id, chat_id, recipient_id))
+
+    before = await scrape(http_url)
+    tasks = [
+        asyncio.create_task(run_user(ws_url, user_id, chat_id, recipient_id, args, stats, started, stop))
+        for user_id, chat_id, recipient_id in users
+    ]
+    # даем сокетам подключиться и подписаться
+    await asyncio.sleep(args.warmup)
+    started.set()
+    start = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - start
+    await asyncio.gather(*tasks)
+    after = await scrape(http_url)
+
+    messages = after['messages'] - before['messages']
+    latencies_ms = [latency * 1000 for latency in stats.latencies]
+    return {
+        'config': {
+            'users': args.users,
+            'fanout': args.fanout,
+            'rate': args.rate,
+            'payload': args.payload,
+            'duration': args.duration,
+        },
+        'sent': stats.sent,
+        'delivered': stats.delivered,
+        'errors': stats.errors,
+        'throughput': {
+            'sent_per_second': round(stats.sent / elapsed, 2),
+            'delivered_per_second': round(stats.delivered / elapsed, 2),
+        },
+        'latency_ms': {
+            'p50': round_or_none(percentile(latencies_ms, 50)),
+            'p95': round_or_none(percentile(latencies_ms, 95)),
+            'p99': round_or_none(percentile(latencies_ms, 99)),
+            'max': round_or_none(max(latencies_ms) if latencies_ms else None),
+            'mean': round_or_none(statistics.fmean(latencies_ms) if latencies_ms else None),
+        },
+        'ops_per_message': {
+            'redis': round((after['redis'] - before['redis']) / messages, 2) if messages else None,
+            'mongo': round((after['mongo'] - before['mongo']) / messages, 2) if messages else None,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='адрес запущенного сервера, например http://127.0.0.1:8000')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--real', action='store_true', help='стенд на настоящих redis / mongo')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--fanout', type=int, default=2, help='участников в чате')
+    parser.add_argument('--rate', type=float, default=1, help='сообщений в секунду от пользователя')
+    parser.add_argument('--payload', type=int, default=64, help='длина текста, байт')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=2)
+    parser.add_argument('--drain', type=float, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    stand = None
+    http_url = args.url
+    if not http_url:
+        command = [sys.executable, '-m', 'benchmarks.stand', '--port', str(args.port)]
+        if args.real:
+            command.append('--real')
+        stand = subprocess.Popen(command, env=os.environ.copy())
+        http_url = f'http://127.0.0.1:{args.port}'
+
+    try:
+        if stand:
+            wait_port('127.0.0.1', args.port)
+        result = asyncio.run(run(args, http_url.rstrip('/')))
+    finally:
+        if stand:
+            stand.terminate()
+            stand.wait()
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+# сравнение pydantic Message и MessageRecord на пути сокет -> publish -> сокет
+# запуск: python -m benchmarks.message_model [--number 20000]
+import argparse
+import json
+import timeit
+import tracemalloc
+from pydantic import BaseModel
+from benchmarks import stand
+
+stand.setup()
+
+from src.messages.model import Message, MessageRecord  # noqa: E402
+from src.sockets_manager import Broadcast, JSON_PROTOCOL  # noqa: E402
+
+
+class PydanticPackage(BaseModel):
+    message: Message
+    lights: None = None
+
+
+def pydantic_roundtrip() -> str:
+    message = Message(user_id=1, chat_id=2, text='Привет, как дела?', reply_id=None,
+                      is_read=False, is_edited=False, recipient_id=3,
+                      sent_at='2024-01-01T10:00:00')
+    payload = message.msgpack_dumps()
+    received = Message.msgpack_loads(payload)
+    return PydanticPackage(message=received).model_dump_json()
+
+
+# тот же путь, что у подписчика: разбор publish и рендер пакета для сокета
+def record_roundtrip() -> str:
+    message = MessageRecord.create(1, 2, 'Привет, как дела?', 3, None, '2024-01-01T10:00:00')
+    payload = message.msgpack_dumps()
+    return Broadcast.from_payload(payload).render(JSON_PROTOCOL)
+
+
+# пиковая память одного прохода после прогрева
+def measure_allocations(func, warmup: int = 100) -> int:
+    for _ in range(warmup):
+        func()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    results = {}
+    for name, func in (('pydantic', pydantic_roundtrip), ('record', record_roundtrip)):
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        results[name] = {
+            'us_per_message': round(best / args.number * 1e6, 2),
+            'peak_bytes_per_message': measure_allocations(func),
+        }
+    results['speedup'] = round(
+        results['pydantic']['us_per_message'] / results['record']['us_per_message'], 2)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# микробенчмарки горячего пути: сериализация сообщения, расчет огоньков, рендер пакета
+# запуск: python -m benchmarks.micro [--number 20000] > micro.json
+import argparse
+import json
+import random
+import timeit
+from benchmarks import stand
+
+stand.setup()
+
+from src.messages.model import Message, MessageRecord  # noqa: E402
+from src.lights.model import Light, LightDTO  # noqa: E402
+from src.sockets_manager import Broadcast, Package, encode_package, JSON_PROTOCOL, MSGPACK_PROTOCOL  # noqa: E402
+
+
+def make_record(text: str = 'Привет, как дела? ' * 4) -> MessageRecord:
+    return MessageRecord.create(1, 2, text, 3, None, '2024-01-01T10:00:00+03:00')
+
+
+def cases() -> dict:
+    record = make_record()
+    prev = make_record('ok')
+    prev.user_id = 3
+    model = record.to_model()
+    payload = record.msgpack_dumps()
+    json_payload = record.json_dumps()
+    lights = LightDTO(user_id=1, chat_id=2, amount=3)
+
+    def render_broadcast(protocol: str):
+        return Broadcast(record, payload).render(protocol)
+
+    return {
+        'message.create_record': lambda: make_record(),
+        'message.create_pydantic': lambda: Message(
+            user_id=1, chat_id=2, text=record.text, recipient_id=3, sent_at='2024-01-01T10:00:00+03:00'),
+        'message.record_msgpack_dumps': record.msgpack_dumps,
+        'message.record_msgpack_loads': lambda: MessageRecord.msgpack_loads(payload),
+        'message.record_json_dumps': record.json_dumps,
+        'message.record_json_loads': lambda: MessageRecord.json_loads(json_payload),
+        'message.pydantic_json_dumps': model.model_dump_json,
+        'message.pydantic_json_loads': lambda: Message.model_validate_json(json_payload),
+        'light.compute': lambda: Light(1, 2, record, prev, False, 1),
+        'light.compute_both_online': lambda: Light(1, 2, record, prev, True, 2),
+        'light.to_dto': Light(1, 2, record, prev, False, 1).to_dto,
+        'package.broadcast_json': lambda: render_broadcast(JSON_PROTOCOL),
+        'package.broadcast_msgpack': lambda: render_broadcast(MSGPACK_PROTOCOL),
+        'package.sender_json': lambda: encode_package(Package(record, lights), JSON_PROTOCOL),
+        'package.sender_msgpack': lambda: encode_package(Package(record, lights), MSGPACK_PROTOCOL),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='запускать только кейсы с этой подстрокой')
+    args = parser.parse_args()
+    random.seed(0)
+
+    results = {}
+    for name, func in cases().items():
+        if args.filter not in name:
+            continue
+        best = min(timeit.repeat(func, number=args.number, repeat=args.repeat))
+        results[name] = round(best / args.number * 1e9)
+
+    print(json.dumps({'ns_per_op': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# стоимость логирования на горячем пути сокета: без логов, log_nowait, фильтры, старый await log
+# запуск: python -m benchmarks.monitor_log [--number 100000]
+import argparse
+import asyncio
+import json
+import time
+from benchmarks import stand
+
+stand.setup()
+
+from monitor import Monitor  # noqa: E402
+
+
+CHAT_ID, USER_ID = 10, 20
+
+
+def hot_path() -> int:
+    # имитация обработки кадра: разбор и проверка сообщения
+    frame = {'message': 'PING', 'sent_at': None}
+    return len(frame['message'])
+
+
+def legacy_format() -> str:
+    # так Monitor.log собирал строку до переноса форматирования в задачу отправки
+    return ";".join([
+        'INFO',
+        f'msg={str("Пользователь вошел в чат" or "")}',
+        f'chat={str(CHAT_ID or "")}',
+        f'user={str(USER_ID or "")}',
+        f'time={str(time.time())}'
+    ])
+
+
+async def run(case: str, number: int) -> float:
+    start = time.perf_counter()
+    for i in range(number):
+        hot_path()
+        if case == 'log_nowait':
+            Monitor.log_nowait("Пользователь вошел в чат", CHAT_ID, USER_ID)
+        elif case == 'filtered_level':
+            Monitor.log_nowait("Пользователь вошел в чат", CHAT_ID, USER_ID, level=Monitor.DEBUG)
+        elif case == 'sampled_1pct':
+            Monitor.log_nowait("Пользователь вошел в чат", CHAT_ID, USER_ID, sample_rate=0.01)
+        elif case == 'await_log':
+            await Monitor.log("Пользователь вошел в чат", CHAT_ID, USER_ID)
+        elif case == 'legacy_format':
+            Monitor.buffer.append((0, legacy_format()))
+        # буфер не переполняется, чтобы не мерить вытеснение
+        if len(Monitor.buffer) >= 1000:
+            Monitor.buffer.clear()
+    elapsed = time.perf_counter() - start
+    Monitor.buffer.clear()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=100000)
+    args = parser.parse_args()
+    # уровень стенда ERROR, здесь меряем запись INFO
+    Monitor.level = Monitor.INFO
+
+    results = {}
+    baseline = await run('disabled', args.number)
+    results['disabled'] = round(baseline / args.number * 1e9)
+    for case in ('log_nowait', 'filtered_level', 'sampled_1pct', 'await_log', 'legacy_format'):
+        results[case] = round(await run(case, args.number) / args.number * 1e9)
+
+    print(json.dumps({
+        'ns_per_call': results,
+        'overhead_ns': {case: value - results['disabled'] for case, value in results.items()},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
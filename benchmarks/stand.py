@@ -0,0 +1,116 @@
+# локальный стенд для нагрузочного теста: приложение на fakeredis / mongomock
+# или на настоящих redis / mongo из docker-compose (--real)
+# запуск: python -m benchmarks.stand [--port 8765] [--real]
+import argparse
+import os
+
+# стенду не нужны внешние сервисы, недостающие настройки заполняются заглушками
+STAND_ENV = {
+    'redis_host': 'localhost',
+    'redis_password': '',
+    'auth_uri': 'http://localhost',
+    'secret_key': 'benchmark',
+    'cors_allow_origins': '*',
+    'gf_security_admin_password': 'benchmark',
+    'mongo_initdb_root_username': 'benchmark',
+    'mongo_initdb_root_password': 'benchmark',
+    'mongo_initdb_database': 'chat',
+    'mongo_initdb_host': 'localhost',
+    'mongo_initdb_port': '27017',
+    'google_conf_path': 'google.json',
+    'google_token_url': 'http://localhost',
+    'firebase_send_address': 'http://localhost',
+    'loki_host': 'localhost',
+    'loki_port': '3100',
+    'loki_level': 'ERROR',
+}
+
+
+# вызывается до импорта config: настройки читаются из окружения при импорте
+def setup() -> None:
+    for key, value in STAND_ENV.items():
+        if key not in os.environ and key.upper() not in os.environ:
+            os.environ[key] = value
+
+
+# mongomock не поддерживает CommandListener, команды считаются на уровне коллекции
+class CountingCollection:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        from src import metrics
+
+        attr = getattr(self.collection, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            metrics.mongo_round_trips.labels(name).inc()
+            return attr(*args, **kwargs)
+        return call
+
+
+class CountingDatabase:
+    def __init__(self, database):
+        self.database = database
+
+    def __getitem__(self, name):
+        return CountingCollection(self.database[name])
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+
+def setup_stand_ins() -> None:
+    import asyncio
+    import time
+    import fakeredis
+    import mongomock_motor
+    from src.pubsub_manager import RedisClient, InstrumentedRedis
+    from mongo_database import MongoDBClient
+
+    # fakeredis не блокируется на XREADGROUP BLOCK, консьюмер пушей крутился бы вхолостую
+    # и забивал счетчик запросов, поэтому блокировка имитируется опросом
+    class StandRedis(InstrumentedRedis):
+        POLL_INTERVAL = 0.05
+
+        async def xreadgroup(self, *args, block: int | None = None, **kwargs):
+            deadline = time.monotonic() + (block or 0) / 1000
+            while True:
+                result = await super().xreadgroup(*args, **kwargs)
+                if result or time.monotonic() >= deadline:
+                    return result
+                await asyncio.sleep(self.POLL_INTERVAL)
+
+    RedisClient.redis_connection = StandRedis(
+        connection_pool=fakeredis.FakeAsyncRedis().connection_pool
+    )
+
+    client = mongomock_motor.AsyncMongoMockClient()
+    database = CountingDatabase(client['chat'])
+    client.get_default_database = lambda *args, **kwargs: database
+    MongoDBClient.client = client
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--real', action='store_true',
+                        help='redis и mongo из настроек окружения вместо заглушек')
+    args = parser.parse_args()
+
+    setup()
+
+    import uvicorn
+    import main as app_module
+
+    if not args.real:
+        setup_stand_ins()
+
+    uvicorn.run(app_module.app, host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+from typing import Literal
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -43,23 +44,79 @@ class FireBaseSettings(BaseSettings):
     google_jwt_ttl: int = Field(default=3600)
     google_token_url: str
     firebase_send_address: str
+    firebase_http2: bool = Field(default=True)
+    firebase_max_connections: int = Field(default=20)
+    firebase_max_keepalive_connections: int = Field(default=10)
+    firebase_keepalive_expiry: float = Field(default=60)
+    firebase_timeout: float = Field(default=5)
+    firebase_connect_timeout: float = Field(default=2)
+
+
+class NotificationsSettings(BaseSettings):
+    notifications_batch_size: int = Field(default=100)
+    notifications_block_ms: int = Field(default=5000)
+    notifications_max_concurrent_sends: int = Field(default=50)
+    notifications_max_attempts: int = Field(default=5)
+    notifications_retry_backoff: float = Field(default=0.5)
+    notifications_retry_backoff_max: float = Field(default=30)
+    notifications_max_deliveries: int = Field(default=5)
+    notifications_reclaim_interval: int = Field(default=30)
+    notifications_reclaim_min_idle_ms: int = Field(default=60000)
+    notifications_dlq_maxlen: int = Field(default=10000)
+    notifications_coalesce_window_ms: int = Field(default=2000)
+    notifications_max_batches_in_flight: int = Field(default=10)
 
 
 class LokiSettings(BaseSettings):
     loki_host: str
     loki_port: int
+    loki_buffer_size: int = Field(default=10000)
+    loki_batch_size: int = Field(default=500)
+    loki_flush_interval: float = Field(default=1)
+    loki_timeout: float = Field(default=2)
+    # gzip | none
+    loki_compression: str = Field(default="gzip")
+    loki_retry_backoff: float = Field(default=1)
+    loki_retry_backoff_max: float = Field(default=30)
+    loki_spill_path: str = Field(default="events.log")
+    loki_spill_max_bytes: int = Field(default=100 * 1024 * 1024)
+    # сколько пачек с диска досылается за один тик отправки
+    loki_replay_batches: int = Field(default=4)
+    # DEBUG | INFO | ERROR, события ниже уровня отбрасываются до форматирования
+    loki_level: str = Field(default="INFO")
+    # доля событий ниже ERROR, которые попадают в буфер
+    loki_sample_rate: float = Field(default=1)
 
     @property
     def loki_endpoint(self):
         return f"http://{self.loki_host}:{str(self.loki_port)}/loki/api/v1/push"
 
 
+class ChatSettings(BaseSettings):
+    messages_batch_window_ms: int = Field(default=0)
+    messages_batch_size: int = Field(default=100)
+    lights_flush_interval: int = Field(default=5)
+    lights_flush_batch_size: int = Field(default=500)
+    presence_ttl: int = Field(default=60)
+    # дублировать непрочитанные чаты в ключи has_mew_msgs_ для старых воркеров,
+    # выключается после выкладки
+    unread_chats_legacy_keys: bool = Field(default=True)
+    ws_send_queue_size: int = Field(default=256)
+    ws_send_queue_policy: Literal["drop_oldest", "coalesce", "disconnect"] = Field(default="drop_oldest")
+    ws_send_queue_close_code: int = Field(default=1013)
+    # формат publish и стрима пушей; msgpack включается, когда все воркеры
+    # и консьюмеры уже умеют читать оба формата
+    messages_wire_format: Literal["json", "msgpack"] = Field(default="json")
+
+
 class AppSettings(RedisSettings,
                   AuthConfig,
                   GrafanaConfig,
                   MongoDBConfig,
                   FireBaseSettings,
-                  LokiSettings):
+                  NotificationsSettings,
+                  LokiSettings,
+                  ChatSettings):
     model_config = SettingsConfigDict(env_file=".env")
 
 
@@ -8,12 +8,16 @@ from fastapi.middleware.cors import CORSMiddleware
 from prometheus_fastapi_instrumentator import Instrumentator
 
 from src.repository import Repository
-from src.messages import chat_router
+from src.messages import chat_router, MessagesRepo
+from src.messages.actions import NEXT_CURSOR_HEADER
 from src.sockets_manager import WebSocketBroadcaster
 from src.lights.actions import lights_router
 from src.lights.repo import LightsRepo
+from src.lights.flusher import LightsFlusher
 from src.notifications.actions import notifications_router
 from src.notifications import consumer
+from src.notifications.firebase import FirebaseClient
+from src.notifications.google_auth import token_provider
 from src.onboarding.preload import preload_assistant_messages
 from src.onboarding.actions import onboarding_router
 from container import AppContainer
@@ -35,6 +39,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 container = AppContainer()
@@ -42,26 +47,40 @@ Instrumentator().instrument(app).expose(app)
 
 
 consumer_ = consumer.Consumer(3)
+lights_flusher = LightsFlusher()
+migrations: asyncio.Task | None = None
 
 
 @app.on_event("startup")
 async def startup():
-    global consumer_
+    global consumer_, lights_flusher, migrations
     await RedisClient.connect()
     await MongoDBClient.connect()
+    await FirebaseClient.connect()
     await Repository.create_indexes()
+    migrations = asyncio.create_task(MessagesRepo().run_migrations())
 
     await preload_assistant_messages()
-    asyncio.create_task(consumer_.main())
+    asyncio.create_task(token_provider.main())
+    consumer_.start()
+    lights_flusher.start()
     asyncio.create_task(Monitor.consume())
 
 
 @app.on_event("shutdown")
 async def shutdown():
-    global consumer_
+    global consumer_, lights_flusher, migrations
 
-    consumer_.is_active = False
+    token_provider.is_active = False
 
+    await WebSocketBroadcaster.multiplexer.close()
+    await WebSocketBroadcaster.writer.close()
+    await lights_flusher.stop()
+    await consumer_.close()
+    if migrations and not migrations.done():
+        migrations.cancel()
+        await asyncio.gather(migrations, return_exceptions=True)
+    await FirebaseClient.disconnect()
     await RedisClient.disconnect()
     await MongoDBClient.disconnect()
     await Monitor.stop()
@@ -1,9 +1,22 @@
 from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorCollection
+from pymongo import monitoring
 from config import settings
 from monitor import Monitor
+from src import metrics
 import asyncio
 
 
+class CommandCounter(monitoring.CommandListener):
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        metrics.mongo_round_trips.labels(event.command_name).inc()
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        pass
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        pass
+
+
 class MongoDBClient:
     client = None
     lock = asyncio.Lock()
@@ -23,7 +36,10 @@ class MongoDBClient:
     async def connect(cls):
         async with cls.lock:
             if not cls.client:
-                cls.client = AsyncIOMotorClient(settings.mongodb_conn_string)
+                cls.client = AsyncIOMotorClient(
+                    settings.mongodb_conn_string,
+                    event_listeners=[CommandCounter()]
+                )
             await Monitor.log("Подключение к Монге открыто")
 
     @classmethod
@@ -1,90 +1,270 @@
 import httpx
 import asyncio
 import aiofiles
+import gzip
 import json
-import datetime
+import os
+import random
 import time
+from collections import deque
 from config import settings
+from src import metrics
+
+
+# (время в нс, уровень, сообщение, чат, пользователь), строка собирается в задаче отправки
+Event = tuple[int, int, str, int | None, int | None]
 
 
 class Monitor:
-    queue = asyncio.Queue()
+    DEBUG = 10
+    INFO = 20
+    ERROR = 40
+    LEVELS = {'DEBUG': DEBUG, 'INFO': INFO, 'ERROR': ERROR}
+    LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+    level = LEVELS.get(settings.loki_level.upper(), INFO)
+    sample_rate = settings.loki_sample_rate
+
+    # кольцевой буфер: при переполнении вытесняются самые старые события
+    buffer: deque[Event] = deque(maxlen=settings.loki_buffer_size)
+    dropped = 0
+    spilled = 0
     is_active = True
+    client: httpx.AsyncClient | None = None
+    ready: asyncio.Event | None = None
+    # пока loki недоступен, пачки пишутся на диск
+    retry_at = 0.0
+    backoff = 0.0
+    # сколько байт файла событий уже дослано в loki
+    replay_offset = 0
 
     @classmethod
     async def stop(cls):
         cls.is_active = False
         await cls.log("Монитор остановлен")
-        await cls._write()
+        while cls.buffer:
+            await cls._ship(cls._take_batch())
+        if cls.client:
+            await cls.client.aclose()
+            cls.client = None
 
     @classmethod
-    async def _write(cls):
-        async with aiofiles.open('events.log', mode='a', encoding='utf-8') as file:
-            while True:
-                try:
-                    item = cls.queue.get_nowait()
-                    if not item or item is None:
-                        break
-                    await file.write(str(item) + "\n")
-                except asyncio.QueueEmpty:
-                    break
+    def _drop(cls, reason: str, count: int = 1) -> None:
+        cls.dropped += count
+        metrics.monitor_dropped_events.labels(reason).inc(count)
 
     @classmethod
-    async def _send_loki(cls):
-        logs = []
-        while True:
-            try:
-                item = cls.queue.get_nowait()
-                if not item or item is None:
-                    break
-                logs.append(item)
-            except asyncio.QueueEmpty:
-                break
-        if not logs:
-            return
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.post(
-                    headers={
-                        'Content-Type': 'application/json',
+    def _get_client(cls) -> httpx.AsyncClient:
+        if not cls.client:
+            cls.client = httpx.AsyncClient(
+                timeout=settings.loki_timeout,
+                limits=httpx.Limits(max_connections=2, max_keepalive_connections=2)
+            )
+        return cls.client
+
+    @classmethod
+    def _take_batch(cls) -> list[Event]:
+        batch = []
+        while cls.buffer and len(batch) < settings.loki_batch_size:
+            batch.append(cls.buffer.popleft())
+        metrics.monitor_buffer_depth.set(len(cls.buffer))
+        return batch
+
+    @classmethod
+    def _encode(cls, values: list[list[str]]) -> tuple[bytes, dict]:
+        body = json.dumps({
+            "streams":
+            [
+                {
+                    "stream": {
+                        "chat": "events"
                     },
-                    timeout=1,
-                    url=settings.loki_endpoint, data=json.dumps({
-                        "streams":
-                        [
-                            {
-                                "stream": {
-                                    "chat": "events"
-                                },
-                                "values": [
-                                    [str(int(datetime.datetime.now().timestamp() * 1e9)),
-                                     str(item)] for item in logs
-                                ]
-                            }
-                        ]
-                    })
-                )
-                if response.status_code != 204:
-                    print(response.text)
-            except (httpx.ConnectTimeout, httpx.ReadTimeout):
-                print("Loki не отвечает")
-                await asyncio.sleep(5)
+                    "values": values
+                }
+            ]
+        }).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json',
+        }
+        if settings.loki_compression == 'gzip':
+            body = gzip.compress(body, compresslevel=1)
+            headers['Content-Encoding'] = 'gzip'
+        return body, headers
 
     @classmethod
-    async def log(cls, msg: str, chat_id: int | None = None, user_id: int | None = None, unknown: bool = False) -> None:
-        payload = ";".join([
-            f'{"INFO" if not unknown else "ERROR"}',
-            f'msg={str(msg or "")}',
+    async def _write(cls, batch: list[Event]) -> None:
+        try:
+            if os.path.getsize(settings.loki_spill_path) >= settings.loki_spill_max_bytes:
+                cls._drop('spill_full', len(batch))
+                return
+        except OSError:
+            pass
+
+        try:
+            async with aiofiles.open(settings.loki_spill_path, mode='a', encoding='utf-8') as file:
+                await file.write("".join(cls._format(event) + "\n" for event in batch))
+        except OSError as e:
+            print(f"Не удалось записать события на диск: {e}")
+            cls._drop('spill_error', len(batch))
+            return
+
+        cls.spilled += len(batch)
+        metrics.monitor_spilled_events.inc(len(batch))
+
+    @classmethod
+    def _backoff(cls) -> None:
+        cls.backoff = min(
+            max(cls.backoff * 2, settings.loki_retry_backoff),
+            settings.loki_retry_backoff_max
+        )
+        cls.retry_at = time.monotonic() + cls.backoff
+
+    @classmethod
+    async def _send_loki(cls, batch: list[Event]) -> bool:
+        return await cls._post([[str(event[0]), cls._format(event)] for event in batch])
+
+    @classmethod
+    async def _post(cls, values: list[list[str]]) -> bool:
+        body, headers = cls._encode(values)
+        try:
+            response = await cls._get_client().post(
+                settings.loki_endpoint, content=body, headers=headers)
+        except httpx.HTTPError:
+            print("Loki не отвечает")
+            return False
+
+        if response.status_code == 204:
+            return True
+        if response.status_code == 429 or response.status_code >= 500:
+            print(response.text)
+            return False
+
+        # loki отклонил пачку, повтор не поможет
+        print(response.text)
+        cls._drop('rejected', len(values))
+        return True
+
+    @classmethod
+    async def _ship(cls, batch: list[Event]) -> None:
+        if not batch:
+            return
+
+        if time.monotonic() < cls.retry_at:
+            await cls._write(batch)
+            return
+
+        if await cls._send_loki(batch):
+            cls.backoff = 0.0
+            return
+
+        cls._backoff()
+        await cls._write(batch)
+
+    @staticmethod
+    def _parse_time(line: str) -> str:
+        try:
+            return str(int(float(line.rsplit(';time=', 1)[1]) * 1e9))
+        except (IndexError, ValueError):
+            return str(time.time_ns())
+
+    # после восстановления loki события с диска досылаются не больше loki_replay_batches
+    # пачек за тик: файл читается построчно с сохраненного смещения, свежие события не ждут.
+    # Файл переименовывается, чтобы новые события писались в свежий; после рестарта файл
+    # читается сначала, повторы с тем же временем и текстом loki отбрасывает
+    @classmethod
+    async def _replay(cls) -> None:
+        if time.monotonic() < cls.retry_at:
+            return
+
+        replay_path = settings.loki_spill_path + '.replay'
+        if not os.path.exists(replay_path):
+            try:
+                os.replace(settings.loki_spill_path, replay_path)
+            except OSError:
+                return
+            cls.replay_offset = 0
+
+        finished = False
+        try:
+            async with aiofiles.open(replay_path, mode='rb') as file:
+                await file.seek(cls.replay_offset)
+                for _ in range(settings.loki_replay_batches):
+                    lines = []
+                    while len(lines) < settings.loki_batch_size:
+                        line = await file.readline()
+                        if not line:
+                            finished = True
+                            break
+                        line = line.decode('utf-8', errors='replace').rstrip('\n')
+                        if line:
+                            lines.append(line)
+
+                    if lines:
+                        if not await cls._post([[cls._parse_time(line), line] for line in lines]):
+                            cls._backoff()
+                            return
+                        metrics.monitor_replayed_events.inc(len(lines))
+                    cls.replay_offset = await file.tell()
+                    if finished:
+                        break
+        except OSError as e:
+            print(f"Не удалось прочитать события с диска: {e}")
+            return
+
+        if finished:
+            os.remove(replay_path)
+            cls.replay_offset = 0
+
+    @staticmethod
+    def _format(event: Event) -> str:
+        ts, level, msg, chat_id, user_id = event
+        return ";".join([
+            Monitor.LEVEL_NAMES.get(level, "INFO"),
+            f'msg={msg}',
             f'chat={str(chat_id or "")}',
             f'user={str(user_id or "")}',
-            f'time={str(time.time())}'
+            f'time={str(ts / 1e9)}'
         ])
 
-        await cls.queue.put(payload)
+    # синхронная запись без форматирования, для горячих путей;
+    # msg приводится к строке сразу, чтобы буфер не держал исключение с его traceback
+    @classmethod
+    def log_nowait(cls, msg: object, chat_id: int | None = None, user_id: int | None = None,
+                   level: int = INFO, sample_rate: float | None = None) -> None:
+        if level < cls.level:
+            return
+        if level < cls.ERROR:
+            rate = cls.sample_rate if sample_rate is None else sample_rate
+            if rate < 1 and random.random() >= rate:
+                return
+
+        if len(cls.buffer) == cls.buffer.maxlen:
+            cls._drop('overflow')
+        cls.buffer.append((time.time_ns(), level, str(msg or ""), chat_id, user_id))
+
+        if cls.ready and len(cls.buffer) >= settings.loki_batch_size:
+            cls.ready.set()
+
+    @classmethod
+    async def log(cls, msg: str, chat_id: int | None = None, user_id: int | None = None, unknown: bool = False) -> None:
+        cls.log_nowait(msg, chat_id, user_id, cls.ERROR if unknown else cls.INFO)
 
     @classmethod
     async def consume(cls):
+        cls.ready = asyncio.Event()
         await cls.log("Монитор запущен")
         while cls.is_active:
-            await cls._send_loki()
-            await asyncio.sleep(1)
+            # пачка уходит по размеру или по таймеру
+            try:
+                await asyncio.wait_for(cls.ready.wait(), settings.loki_flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            cls.ready.clear()
+
+            while cls.buffer and cls.is_active:
+                await cls._ship(cls._take_batch())
+                if len(cls.buffer) < settings.loki_batch_size:
+                    break
+
+            if cls.is_active:
+                await cls._replay()
@@ -0,0 +1,39 @@
+import asyncio
+from src.lights.repo import LightsRepo
+from config import settings
+from monitor import Monitor
+
+
+class LightsFlusher:
+    def __init__(self, interval: int = settings.lights_flush_interval):
+        self.lights_repo: LightsRepo = LightsRepo()
+        self.interval = interval
+        self.is_active = True
+        self.stopped = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    async def flush(self) -> None:
+        try:
+            await self.lights_repo.flush()
+        except Exception as e:
+            await Monitor.log(str(e), unknown=True)
+
+    async def main(self):
+        while self.is_active:
+            try:
+                await asyncio.wait_for(self.stopped.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.main())
+
+    # дожидаемся текущего сброса, последний сброс забирает все, что осталось
+    async def stop(self) -> None:
+        self.is_active = False
+        self.stopped.set()
+        if self.task:
+            await self.task
+            self.task = None
+        await self.flush()
@@ -1,6 +1,6 @@
 from enum import Enum
 import random
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 from datetime import datetime
 from src.messages.model import Message
 
@@ -21,7 +21,7 @@ class LightDTO(BaseModel):
     user_id: int
     chat_id: int
     amount: int
-    updated_at: datetime = datetime.now()
+    updated_at: datetime = Field(default_factory=datetime.now)
 
     def __init__(self, *args, **kwargs):
         _id = kwargs.get('_id') or kwargs.get('id')
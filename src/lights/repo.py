@@ -1,4 +1,6 @@
 from bson.objectid import ObjectId
+from pymongo import UpdateOne, IndexModel
+from pymongo.errors import BulkWriteError
 from typing import List, Union
 import json
 import datetime
@@ -6,66 +8,200 @@ from sqlalchemy.sql import select
 from src.repository import Repository
 from src.lights.model import LightDTO, Operation
 from src.pubsub_manager import RedisClient
+from config import settings
 
 
 class LightsRepo(Repository):
-    # mongo
-    async def save_up(self, light: LightDTO) -> LightDTO | None:
-        if light.amount == 0:
-            return
-        async with self.mongo_client(self.lights_collection) as collection:
-            user_lights = await collection.find_one({
-                'user_id': light.user_id,
-                'chat_id': light.chat_id
-            })
-            if not user_lights:
-                new_light = light.model_dump()
-                await collection.insert_one(new_light)
-            else:
-                ex_light = LightDTO(**user_lights)
-                new_light = ex_light + light
-                await collection.update_one(
-                    {"_id": ObjectId(ex_light.id)},
-                    {
-                        "$set": {
-                            'amount': new_light.amount,
-                            'updated_at': new_light.updated_at
-                        }
-                    }
-                )
-            return new_light
+    # хеш балансов чата, поле - пользователь; ttl продлевается при каждой записи,
+    # так что в редисе остаются только активные чаты
+    balances_key = "lights_balances_"
+    balances_ttl = 24 * 60 * 60
+    # рядом с балансом хранится время изменения по часам редиса, по нему монга
+    # не принимает снимок старее уже записанного другим воркером
+    version_suffix = ":v"
+    dirty_key = "lights_dirty"
+    field_delimeter = ":"
+
+    indexes = {
+        Repository.lights_collection: [
+            IndexModel([("user_id", 1), ("chat_id", 1)],
+                       unique=True),
+        ]
+    }
+
+    # возвращает nil, если баланса нет в кэше и его нужно подгрузить из монги
+    accrue_script = """
+        if redis.call('HEXISTS', KEYS[1], ARGV[1]) == 0 then
+            return nil
+        end
+        local amount = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        local time = redis.call('TIME')
+        redis.call('HSET', KEYS[1], ARGV[5], time[1] .. string.format('%06d', time[2]))
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        redis.call('SADD', KEYS[2], ARGV[3])
+        return amount
+    """
+
+    withdrawn_script = """
+        local amount = redis.call('HGET', KEYS[1], ARGV[1])
+        if not amount then
+            return nil
+        end
+        local current = tonumber(amount)
+        amount = current - tonumber(ARGV[2])
+        if amount < 0 then
+            amount = 0
+        end
+        if amount ~= current then
+            local time = redis.call('TIME')
+            redis.call('HSET', KEYS[1], ARGV[1], amount,
+                       ARGV[5], time[1] .. string.format('%06d', time[2]))
+            redis.call('SADD', KEYS[2], ARGV[3])
+        end
+        redis.call('EXPIRE', KEYS[1], ARGV[4])
+        return amount
+    """
+
+    def get_balances_key(self, chat_id: int) -> str:
+        return f"{self.balances_key}{str(chat_id)}"
+
+    def get_version_field(self, user_id: int) -> str:
+        return f"{str(user_id)}{self.version_suffix}"
+
+    def get_field(self, chat_id: int, user_id: int) -> str:
+        return f"{str(chat_id)}{self.field_delimeter}{str(user_id)}"
+
+    def parse_field(self, field: bytes) -> tuple[int, int]:
+        chat_id, user_id = field.decode('utf-8').split(self.field_delimeter)
+        return int(chat_id), int(user_id)
 
     # mongo
-    async def withdrawn(self, chat_id: int, user_id: int, amount: int = 0):
+    async def _load_amount(self, chat_id: int, user_id: int) -> int | None:
         async with self.mongo_client(self.lights_collection) as collection:
             user_lights = await collection.find_one({
                 'user_id': user_id,
                 'chat_id': chat_id
             })
-            if not user_lights:
-                return
-            light = LightDTO(**user_lights)
-
-            if light.amount < amount:
-                new_amount = 0
-            else:
-                new_amount = light.amount - amount
-
-            await collection.update_one(
-                {"_id": ObjectId(light.id)},
-                {
-                    "$set": {
-                        'amount': new_amount,
-                        'updated_at': datetime.datetime.now()
-                    }
-                }
-            )
+            return LightDTO(**user_lights).amount if user_lights else None
 
-    # mongo
+    # redis
+    async def _warm_up(self, chat_id: int, user_id: int, amount: int) -> None:
+        key = self.get_balances_key(chat_id)
+        async with RedisClient() as r:
+            async with r.pipeline(transaction=False) as pipe:
+                pipe.hsetnx(key, user_id, amount)
+                pipe.expire(key, self.balances_ttl)
+                await pipe.execute()
+
+    # redis
+    async def _call_script(self, script: str, chat_id: int, user_id: int, amount: int,
+                           create: bool = True) -> int | None:
+        keys = [self.get_balances_key(chat_id), self.dirty_key]
+        args = [user_id, amount, self.get_field(chat_id, user_id), self.balances_ttl,
+                self.get_version_field(user_id)]
+
+        result = await RedisClient.get_script(script)(keys=keys, args=args)
+        if result is None:
+            loaded = await self._load_amount(chat_id, user_id)
+            if loaded is None and not create:
+                return None
+            await self._warm_up(chat_id, user_id, loaded or 0)
+            result = await RedisClient.get_script(script)(keys=keys, args=args)
+
+        return int(result or 0)
+
+    # redis, в монгу попадает через flush
+    async def save_up(self, light: LightDTO) -> LightDTO | None:
+        if light.amount == 0:
+            return
+        amount = await self._call_script(
+            self.accrue_script, light.chat_id, light.user_id, light.amount
+        )
+        return LightDTO(
+            user_id=light.user_id,
+            chat_id=light.chat_id,
+            amount=amount
+        )
+
+    # redis, в монгу попадает через flush; без баланса ничего не делаем
+    async def withdrawn(self, chat_id: int, user_id: int, amount: int = 0) -> int | None:
+        return await self._call_script(
+            self.withdrawn_script, chat_id, user_id, amount, create=False
+        )
+
+    # redis
     async def calc_amount(self, user_id: int, chat_id: int) -> int:
+        key = self.get_balances_key(chat_id)
+
+        async with RedisClient() as r:
+            amount = await r.hget(key, user_id)
+        if amount is not None:
+            return int(amount)
+
+        # нулевой баланс тоже кэшируем: списание с нуля ничего не меняет и в монгу не пишет
+        await self._warm_up(chat_id, user_id, await self._load_amount(chat_id, user_id) or 0)
+        async with RedisClient() as r:
+            amount = await r.hget(key, user_id)
+        return int(amount or 0)
+
+    # redis, баланс и его версия
+    async def _get_amounts(self, fields: list[bytes]) -> list[list[bytes | None]]:
+        parsed = [self.parse_field(field) for field in fields]
+        async with RedisClient() as r:
+            async with r.pipeline(transaction=False) as pipe:
+                for chat_id, user_id in parsed:
+                    pipe.hmget(self.get_balances_key(chat_id), user_id, self.get_version_field(user_id))
+                return await pipe.execute()
+
+    # mongo, снимок старее записанного не совпадает по версии, и upsert упирается
+    # в уникальный индекс. Такие операции повторяются один раз: при гонке двух первых
+    # записей проигравшая могла быть новее. Повторная ошибка - в монге уже более новый баланс
+    async def _write_amounts(self, operations: list[UpdateOne]) -> None:
         async with self.mongo_client(self.lights_collection) as collection:
-            user_lights = await collection.find_one({
-                'user_id': user_id,
-                'chat_id': chat_id
-            })
-            return LightDTO(**user_lights).amount if user_lights else 0
+            for _ in range(2):
+                try:
+                    await collection.bulk_write(operations, ordered=False)
+                    return
+                except BulkWriteError as e:
+                    errors = e.details.get('writeErrors', [])
+                    if e.details.get('writeConcernErrors') or \
+                            any(error['code'] != 11000 for error in errors):
+                        raise
+                    operations = [operations[error['index']] for error in errors]
+
+    # redis -> mongo
+    async def flush(self, batch_size: int = settings.lights_flush_batch_size) -> int:
+        flushed = 0
+
+        while True:
+            async with RedisClient() as r:
+                fields = await r.spop(self.dirty_key, batch_size)
+                if not fields:
+                    return flushed
+            amounts = await self._get_amounts(fields)
+
+            now = datetime.datetime.now()
+            operations = []
+            for field, (amount, version) in zip(fields, amounts):
+                if amount is None:
+                    continue
+                chat_id, user_id = self.parse_field(field)
+                query = {'user_id': user_id, 'chat_id': chat_id}
+                values = {'amount': int(amount), 'updated_at': now}
+                if version is not None:
+                    query['version'] = {'$not': {'$gte': int(version)}}
+                    values['version'] = int(version)
+                operations.append(UpdateOne(query, {"$set": values}, upsert=True))
+
+            try:
+                if operations:
+                    await self._write_amounts(operations)
+            except Exception:
+                # вернем ключи в очередь, чтобы не потерять балансы
+                async with RedisClient() as r:
+                    await r.sadd(self.dirty_key, *fields)
+                raise
+
+            flushed += len(operations)
+            if len(fields) < batch_size:
+                return flushed
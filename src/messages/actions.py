@@ -1,17 +1,18 @@
 import time
 from typing import Annotated, List
-from fastapi import APIRouter, Depends, WebSocket, Query, WebSocketDisconnect, WebSocketException, Body
+from fastapi import APIRouter, Depends, WebSocket, Query, WebSocketDisconnect, WebSocketException, Body, Response
 from fastapi.concurrency import run_until_first_complete
 from dependency_injector.wiring import inject, Provide
 
 from src.messages.model import Message
 from container import AppContainer, MessagesRepo
-from src.sockets_manager import get_broadcaster
+from src.sockets_manager import get_broadcaster, UserSession, negotiate_protocol, JSON_PROTOCOL
 from src import metrics
 from monitor import Monitor
 
 
 chat_router = APIRouter(prefix="/messages", tags=["messages"])
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
 
 
 broadcaster = get_broadcaster('pubsub')
@@ -27,13 +28,7 @@ async def list_last_messages(
     chats: list[int],
     messages_repo: MessagesRepo = Depends(Provide[AppContainer.messages_repo])
 ):
-    result = {}
-    for chat_id in chats:
-        last_message = await messages_repo.get_last_chat_message(chat_id)
-        if not last_message:
-            continue
-        result[chat_id] = last_message
-    return result
+    return await messages_repo.get_last_chat_messages(chats)
 
 
 @chat_router.post(
@@ -52,6 +47,7 @@ async def mark_all_read(
         chat_id,
         False
     )
+    await messages_repo.reset_unread_counter(user_id, chat_id)
 
 
 @chat_router.get(
@@ -78,16 +74,28 @@ async def mark_read(messages_ids: list[str],
 
 @chat_router.get("/",
                  summary='Список сообщений конкретного чата',
+                 description='Курсор следующей страницы возвращается в заголовке X-Next-Cursor, '
+                             'его нужно передать в before. page используется, только если before не передан',
                  response_model=List[Message])
 @inject
 async def list_messages(
+        response: Response,
         chat_id: int,
         page: Annotated[int, Query(ge=1)] = 1,
         size: Annotated[int, Query(ge=1)] = 1,
+        before: Annotated[str | None, Query()] = None,
         messages_repo: MessagesRepo = Depends(
             Provide[AppContainer.messages_repo])
 ):
-    return await messages_repo.list_messages(chat_id, page, size)
+    if before:
+        messages = await messages_repo.list_messages_before(chat_id, before, size)
+    else:
+        messages = await messages_repo.list_messages(chat_id, page, size)
+
+    if messages:
+        response.headers[NEXT_CURSOR_HEADER] = messages_repo.get_history_cursor(
+            messages[-1])
+    return messages
 
 
 @chat_router.get("/new",
@@ -147,26 +155,55 @@ async def on_message_event_v2(websocket: WebSocket,
                               layer: Annotated[int, Query()],
                               reply_id: Annotated[int | None, Query()] = None
                               ):
-    await Monitor.log("Пользователь вошел в чат", chat_id, user_id)
-    await websocket.accept()
+    Monitor.log_nowait("Пользователь вошел в чат", chat_id, user_id)
+    protocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=protocol if protocol != JSON_PROTOCOL else None)
     metrics.ws_connections.inc()
+    socket_id = await broadcaster.presence_repo.connect(user_id, chat_id)
+
+    try:
+        await run_until_first_complete(
+            (broadcaster.chat_ws_receiver, {
+                "websocket": websocket,
+                "chat_id": chat_id,
+                'user_id': user_id,
+                'layer': layer,
+                'reply_id': reply_id,
+                'recipient_id': recipient_id,
+                'socket_id': socket_id
+            }),
+            (broadcaster.chat_ws_sender, {
+                "websocket": websocket,
+                "chat_id": chat_id,
+                'layer': layer,
+                'user_id': user_id,
+                'recipient_id': recipient_id,
+                'protocol': protocol
+            }),
+        )
+    finally:
+        await broadcaster.presence_repo.disconnect(user_id, chat_id, socket_id)
+    metrics.ws_connections.dec()
+    Monitor.log_nowait("Пользователь вышел из чата", chat_id, user_id)
 
-    await run_until_first_complete(
-        (broadcaster.chat_ws_receiver, {
-            "websocket": websocket,
-            "chat_id": chat_id,
-            'user_id': user_id,
-            'layer': layer,
-            'reply_id': reply_id,
-            'recipient_id': recipient_id
-        }),
-        (broadcaster.chat_ws_sender, {
-            "websocket": websocket,
-            "chat_id": chat_id,
-            'layer': layer,
-            'user_id': user_id,
-            'recipient_id': recipient_id
-        }),
-    )
+
+@chat_router.websocket("/connect/user")
+async def on_user_event(websocket: WebSocket,
+                        user_id: Annotated[int, Query()],
+                        layer: Annotated[int, Query()]
+                        ):
+    Monitor.log_nowait("Пользователь подключился", None, user_id)
+    protocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=protocol if protocol != JSON_PROTOCOL else None)
+    metrics.ws_connections.inc()
+
+    session = UserSession(websocket, user_id, layer, protocol)
+    try:
+        await run_until_first_complete(
+            (broadcaster.user_ws_receiver, {"session": session}),
+            (broadcaster.user_ws_sender, {"session": session}),
+        )
+    finally:
+        await broadcaster.close_session(session)
     metrics.ws_connections.dec()
-    await Monitor.log("Пользователь вышел из чата", chat_id, user_id)
+    Monitor.log_nowait("Пользователь отключился", None, user_id)
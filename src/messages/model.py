@@ -1,23 +1,51 @@
 import json
+import msgpack
+from dataclasses import dataclass, field
 from typing import Any
 from datetime import datetime, timezone, timedelta
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter
+from pydantic_core import from_json, to_json
 
 
 tzinfo = timezone(timedelta(hours=3))
 
+# поле записи стрима / хеша с сообщением в msgpack
+PAYLOAD_FIELD = 'payload'
+
+# msgpack.packb заводит новый буфер на 256 КБ на каждый вызов, упаковщик переиспользует свой
+_packer = msgpack.Packer()
+
+
+def packb(obj: Any) -> bytes:
+    return _packer.pack(obj)
+
+
+def now() -> datetime:
+    return datetime.now(tzinfo)
+
+
+_datetime_adapter = TypeAdapter(datetime)
+
+
+# правила поля datetime в pydantic: iso-строка или число секунд, а при abs > 2e10
+# миллисекунд (Date.now() в js); ValidationError наследует ValueError
+def parse_datetime(value: Any) -> datetime:
+    if isinstance(value, datetime):
+        return value
+    return _datetime_adapter.validate_python(value)
+
 
 class Message(BaseModel):
     user_id: int
     chat_id: int
     text: str
-    created_at: datetime = datetime.now(tzinfo)
+    created_at: datetime = Field(default_factory=now)
     is_edited: bool = Field(default=False)
     id: str | None = None
     reply_id: int | str | None = None
     is_read: bool = Field(default=False)
     recipient_id: int | None = None
-    sent_at: datetime = datetime.now(tzinfo)
+    sent_at: datetime = Field(default_factory=now)
 
     def __init__(self, *args, **kwargs):
         _id = kwargs.get('_id') or kwargs.get('id')
@@ -42,6 +70,10 @@ class Message(BaseModel):
 
     @staticmethod
     def deserialize(payload: dict[bytes, bytes]) -> 'Message':
+        packed = payload.get(PAYLOAD_FIELD.encode('utf-8'))
+        if packed is not None:
+            return Message.msgpack_loads(packed)
+        # записи в старом формате, поле на строку
         return Message(**{
             k.decode('utf-8'): v.decode('utf-8') for k, v in payload.items()
         })
@@ -54,3 +86,145 @@ class Message(BaseModel):
         return Message(**{
             k: v for k, v in json.loads(payload).items()
         })
+
+    def msgpack_dumps(self) -> bytes:
+        return packb(self.model_dump(mode='json'))
+
+    @staticmethod
+    def msgpack_loads(payload: bytes) -> 'Message':
+        return Message(**msgpack.unpackb(payload))
+
+
+# сообщение на горячем пути: сокет -> монга/редис -> сокет, без валидации pydantic.
+# Message остается на границе http api, переход через from_model / to_model
+@dataclass(slots=True)
+class MessageRecord:
+    user_id: int
+    chat_id: int
+    text: str
+    created_at: datetime = field(default_factory=now)
+    is_edited: bool = False
+    id: str | None = None
+    reply_id: int | str | None = None
+    is_read: bool = False
+    recipient_id: int | None = None
+    sent_at: datetime | None = None
+
+    def __post_init__(self):
+        if self.sent_at is None:
+            self.sent_at = self.created_at
+
+    # разбор данных от клиента, ValueError вместо ValidationError
+    @classmethod
+    def create(cls, user_id: int, chat_id: int, text: str, recipient_id: int | None,
+               reply_id: Any = None, sent_at: Any = None) -> 'MessageRecord':
+        if not isinstance(text, str):
+            raise ValueError("Некорректный текст сообщения")
+        if reply_id is not None and (isinstance(reply_id, bool) or not isinstance(reply_id, (int, str))):
+            raise ValueError("Некорректный reply_id: %r" % (reply_id,))
+
+        created_at = now()
+        return cls(
+            user_id=int(user_id),
+            chat_id=int(chat_id),
+            text=text,
+            created_at=created_at,
+            reply_id=reply_id,
+            recipient_id=int(recipient_id) if recipient_id is not None else None,
+            sent_at=parse_datetime(sent_at) if sent_at else datetime.now()
+        )
+
+    @classmethod
+    def from_model(cls, message: Message) -> 'MessageRecord':
+        return cls(
+            user_id=message.user_id,
+            chat_id=message.chat_id,
+            text=message.text,
+            created_at=message.created_at,
+            is_edited=message.is_edited,
+            id=message.id,
+            reply_id=message.reply_id,
+            is_read=message.is_read,
+            recipient_id=message.recipient_id,
+            sent_at=message.sent_at
+        )
+
+    def to_model(self) -> Message:
+        return Message.model_construct(**self.to_document())
+
+    # документ монги в том же виде, что давал Message.model_dump()
+    def to_document(self) -> dict:
+        return {
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'text': self.text,
+            'created_at': self.created_at,
+            'is_edited': self.is_edited,
+            'id': self.id,
+            'reply_id': self.reply_id,
+            'is_read': self.is_read,
+            'recipient_id': self.recipient_id,
+            'sent_at': self.sent_at
+        }
+
+    # то же, что Message.model_dump(mode='json')
+    def to_wire(self) -> dict:
+        return {
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'text': self.text,
+            'created_at': self.created_at.isoformat(),
+            'is_edited': self.is_edited,
+            'id': self.id,
+            'reply_id': self.reply_id,
+            'is_read': self.is_read,
+            'recipient_id': self.recipient_id,
+            'sent_at': self.sent_at.isoformat()
+        }
+
+    @classmethod
+    def from_wire(cls, payload: dict) -> 'MessageRecord':
+        return cls(
+            user_id=payload['user_id'],
+            chat_id=payload['chat_id'],
+            text=payload['text'],
+            created_at=datetime.fromisoformat(payload['created_at']),
+            is_edited=payload.get('is_edited', False),
+            id=payload.get('id'),
+            reply_id=payload.get('reply_id'),
+            is_read=payload.get('is_read', False),
+            recipient_id=payload.get('recipient_id'),
+            sent_at=datetime.fromisoformat(payload['sent_at']) if payload.get('sent_at') else None
+        )
+
+    # поля записи стрима в формате Message.serialize(), их читают консьюмеры без msgpack
+    def to_fields(self) -> dict:
+        fields = {
+            'user_id': self.user_id,
+            'chat_id': self.chat_id,
+            'text': self.text,
+            'created_at': str(self.created_at),
+            'is_edited': str(self.is_edited),
+            'id': self.id or "",
+            'reply_id': self.reply_id or "",
+            'is_read': str(self.is_read),
+            'sent_at': str(self.sent_at)
+        }
+        if self.recipient_id is not None:
+            fields['recipient_id'] = self.recipient_id
+        return fields
+
+    def msgpack_dumps(self) -> bytes:
+        return packb(self.to_wire())
+
+    @classmethod
+    def msgpack_loads(cls, payload: bytes) -> 'MessageRecord':
+        return cls.from_wire(msgpack.unpackb(payload))
+
+    # pydantic_core кодирует json в 2-3 раза быстрее модуля json
+    def json_dumps(self) -> str:
+        return to_json(self.to_wire()).decode('utf-8')
+
+    @classmethod
+    def json_loads(cls, payload: bytes | str) -> 'MessageRecord':
+        return cls.from_wire(from_json(payload))
@@ -1,20 +1,98 @@
 from typing import Union
 from bson import ObjectId
+from bson.errors import InvalidId
+from collections import Counter
+from pymongo import IndexModel, UpdateOne
+from pymongo.errors import BulkWriteError
+import base64
+import binascii
 import json
 import datetime
 import pytz
 from typing import List
 from sqlalchemy.sql import select, update, text
 from sqlalchemy import desc, func
-from src.messages.model import Message
+from src.messages.model import Message, MessageRecord
 from src.repository import Repository
 from src.pubsub_manager import RedisClient
+from config import settings
+from monitor import Monitor
 
 
 class MessagesRepo(Repository):
+    # устаревшие ключи вида has_mew_msgs_<user>:<chat>, переносятся в множества unread_chats_
     has_new_messages_key = "has_mew_msgs_"
     has_new_messages_key_delimeter = ":"
+    unread_chats_key = "unread_chats_"
+    unread_chats_migration_key = "unread_chats_migrated"
+    migration_lock_suffix = "_lock"
+    migration_lock_ttl = 5 * 60
     last_message_key = "last_message_"
+    history_cursor_delimeter = "|"
+    history_sort = [("created_at", -1), ("_id", -1)]
+
+    indexes = {
+        Repository.messages_collection: [
+            # история чата, в том числе keyset пагинация
+            IndexModel([("chat_id", 1), ("created_at", -1), ("_id", -1)]),
+            # непрочитанные сообщения в чате
+            IndexModel([("chat_id", 1), ("user_id", 1), ("created_at", -1)],
+                       partialFilterExpression={"is_read": False},
+                       name="chat_id_1_user_id_1_created_at_-1_unread"),
+            # непрочитанные получателя: запасной подсчет до миграции счетчиков, сама миграция
+            # и остаток после сброса счетчика
+            IndexModel([("recipient_id", 1), ("chat_id", 1)],
+                       partialFilterExpression={"is_read": False},
+                       name="recipient_id_1_chat_id_1_unread"),
+        ],
+        Repository.unread_counters_collection: [
+            IndexModel([("user_id", 1), ("chat_id", 1)],
+                       unique=True),
+        ]
+    }
+
+    unread_counters_key = "unread_counters_"
+    unread_counters_version_key = "unread_counters_version_"
+    unread_counters_loaded_field = "loaded"
+    unread_counters_ttl = 24 * 60 * 60
+    unread_counters_load_attempts = 3
+    unread_counters_migration_key = "unread_counters_migrated"
+    # после завершения миграции маркер уже не снимается, проверяем его до первого успеха
+    unread_counters_migrated = False
+
+    # счетчик меняется, только если он уже загружен из монги; иначе сдвигается версия,
+    # чтобы загрузка, прочитавшая монгу раньше этого изменения, не закэшировала старый снимок
+    incr_unread_counter_script = """
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            redis.call('INCR', KEYS[2])
+            redis.call('EXPIRE', KEYS[2], ARGV[3])
+            return nil
+        end
+        local count = redis.call('HINCRBY', KEYS[1], ARGV[1], ARGV[2])
+        if count < 0 then
+            redis.call('HSET', KEYS[1], ARGV[1], 0)
+            count = 0
+        end
+        return count
+    """
+
+    # снимок из монги кладется, только если версия не менялась с момента чтения
+    load_unread_counters_script = """
+        if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+            return 0
+        end
+        if redis.call('EXISTS', KEYS[1]) == 0 then
+            redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+            redis.call('EXPIRE', KEYS[1], ARGV[2])
+        end
+        return 1
+    """
+
+    def get_unread_chats_key(self, user_id: int) -> str:
+        return f"{self.unread_chats_key}{str(user_id)}"
+
+    def get_has_new_messages_key(self, user_id: int, chat_id: int) -> str:
+        return f"{self.has_new_messages_key}{str(user_id)}{self.has_new_messages_key_delimeter}{str(chat_id)}"
 
     async def list_has_new_messages(self, user_id: int) -> list[int]:
         try:
@@ -23,12 +101,7 @@ class MessagesRepo(Repository):
             return []
 
         async with RedisClient() as client:
-            keys = await client.keys(pattern=f'{self.has_new_messages_key}{str(user_id)}{self.has_new_messages_key_delimeter}*')
-            return [
-                int(key.decode(
-                    'utf-8').split(self.has_new_messages_key_delimeter)[1])
-                for key in keys
-            ]
+            return [int(chat_id) for chat_id in await client.smembers(self.get_unread_chats_key(user_id))]
 
     async def update_has_new_messages(
         self, user_id: int, chat_id: int, new_state: bool
@@ -42,32 +115,286 @@ class MessagesRepo(Repository):
         if not isinstance(new_state, bool):
             return
 
-        key = f"{self.has_new_messages_key}{str(user_id)}{self.has_new_messages_key_delimeter}{str(chat_id)}"
+        key = self.get_unread_chats_key(user_id)
 
         async with RedisClient() as client:
             if new_state:
-                await client.setnx(key, 1)
+                await client.sadd(key, chat_id)
             else:
-                await client.delete(key)
+                await client.srem(key, chat_id)
+                if settings.unread_chats_legacy_keys:
+                    await client.delete(self.get_has_new_messages_key(user_id, chat_id))
+
+    # redis, маркер завершения ставится только после переноса. Блокировка с коротким ttl
+    # не дает воркерам делать одну работу одновременно, упавший перенос повторится
+    # на следующем старте; сам перенос идемпотентен
+    async def run_migration(self, marker: str, migrate) -> None:
+        lock = f"{marker}{self.migration_lock_suffix}"
+        async with RedisClient() as client:
+            if await client.exists(marker):
+                return
+            if not await client.set(lock, 1, nx=True, ex=self.migration_lock_ttl):
+                return
+
+        done = False
+        try:
+            await migrate()
+            done = True
+        except Exception as e:
+            await Monitor.log(f"Миграция {marker} не завершена: {e}", unknown=True)
+        finally:
+            # и при отмене на остановке воркера, чтобы следующий старт не ждал ttl блокировки
+            async with RedisClient() as client:
+                if done:
+                    await client.set(marker, 1)
+                await client.delete(lock)
+
+        if done:
+            await Monitor.log(f"Миграция {marker} завершена")
+
+    # redis, переносит старые ключи в множества. Пока идет выкладка, старые воркеры
+    # пишут и читают ключи has_mew_msgs_: ключи только копируются, маркер не ставится,
+    # окончательный перенос делает первый старт после выключения флага
+    async def migrate_has_new_messages(self, batch_size: int = 1000) -> None:
+        if settings.unread_chats_legacy_keys:
+            try:
+                await self._migrate_has_new_messages(batch_size, delete=False)
+            except Exception as e:
+                await Monitor.log(f"Копирование ключей {self.has_new_messages_key} не завершено: {e}",
+                                  unknown=True)
+            return
+
+        await self.run_migration(
+            self.unread_chats_migration_key,
+            lambda: self._migrate_has_new_messages(batch_size)
+        )
+
+    async def _migrate_has_new_messages(self, batch_size: int, delete: bool = True) -> None:
+        pattern = f"{self.has_new_messages_key}*{self.has_new_messages_key_delimeter}*"
+
+        async with RedisClient() as client:
+            keys = []
+            async for key in client.scan_iter(match=pattern, count=batch_size):
+                keys.append(key)
+                if len(keys) >= batch_size:
+                    await self._migrate_has_new_messages_keys(client, keys, delete)
+                    keys = []
+            if keys:
+                await self._migrate_has_new_messages_keys(client, keys, delete)
+
+    # sadd + del повторяются без вреда, если перенос прервался на середине
+    async def _migrate_has_new_messages_keys(self, client, keys: list[bytes], delete: bool = True) -> None:
+        async with client.pipeline(transaction=False) as pipe:
+            for key in keys:
+                user_id, chat_id = key.decode('utf-8').removeprefix(
+                    self.has_new_messages_key).split(self.has_new_messages_key_delimeter)
+                pipe.sadd(self.get_unread_chats_key(user_id), chat_id)
+                if delete:
+                    pipe.delete(key)
+            await pipe.execute()
+
+    def get_unread_counters_key(self, user_id: int) -> str:
+        return f"{self.unread_counters_key}{str(user_id)}"
+
+    def count_unread(self, messages: list[Message]) -> dict[tuple[int, int], int]:
+        return Counter(
+            (int(message.recipient_id), int(message.chat_id))
+            for message in messages if message.recipient_id
+        )
+
+    # mongo
+    async def save_unread_counters(self, counters: dict[tuple[int, int], int]) -> None:
+        if not counters:
+            return
+
+        async with self.mongo_client(self.unread_counters_collection) as collection:
+            await collection.bulk_write([
+                UpdateOne(
+                    {'user_id': user_id, 'chat_id': chat_id},
+                    [{"$set": {'count': {"$max": [
+                        0, {"$add": [{"$ifNull": ["$count", 0]}, amount]}
+                    ]}}}],
+                    upsert=True
+                )
+                for (user_id, chat_id), amount in counters.items()
+            ], ordered=False)
+
+    # redis
+    async def cache_unread_counters(self, pipe, counters: dict[tuple[int, int], int]) -> None:
+        script = RedisClient.get_script(self.incr_unread_counter_script)
+        for (user_id, chat_id), amount in counters.items():
+            await script(
+                keys=[self.get_unread_counters_key(user_id),
+                      self.get_unread_counters_version_key(user_id)],
+                args=[chat_id, amount, self.unread_counters_ttl],
+                client=pipe
+            )
+
+    # mongo + redis
+    async def incr_unread_counters(self, counters: dict[tuple[int, int], int]) -> None:
+        if not counters:
+            return
+
+        await self.save_unread_counters(counters)
+        async with RedisClient() as client:
+            async with client.pipeline(transaction=False) as pipe:
+                await self.cache_unread_counters(pipe, counters)
+                await pipe.execute()
+
+    # mongo + redis, сообщения помечаются прочитанными вместе со сбросом счетчика,
+    # иначе поштучный mark_read по ним потом уменьшил бы уже обнуленный счетчик
+    async def reset_unread_counter(self, user_id: int, chat_id: int) -> None:
+        try:
+            user_id = int(user_id)
+            chat_id = int(chat_id)
+        except ValueError:
+            return
+
+        async with self.mongo_client(self.messages_collection) as collection:
+            await collection.update_many(
+                {'chat_id': chat_id, 'user_id': {"$ne": user_id}, 'is_read': False},
+                {"$set": {'is_read': True}}
+            )
+            # сообщения, пришедшие после update_many, остаются в счетчике
+            unread = await collection.count_documents(
+                {'chat_id': chat_id, 'recipient_id': user_id, 'is_read': False}
+            )
+
+        async with self.mongo_client(self.unread_counters_collection) as collection:
+            await collection.update_one(
+                {'user_id': user_id, 'chat_id': chat_id},
+                {"$set": {'count': unread}}
+            )
+        # кэш пользователя перечитается из монги при следующем запросе,
+        # версия не дает параллельной загрузке положить снимок до сброса
+        version_key = self.get_unread_counters_version_key(user_id)
+        async with RedisClient() as client:
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.delete(self.get_unread_counters_key(user_id))
+                pipe.incr(version_key)
+                pipe.expire(version_key, self.unread_counters_ttl)
+                await pipe.execute()
+
+    def get_unread_counters_version_key(self, user_id: int) -> str:
+        return f"{self.unread_counters_version_key}{str(user_id)}"
+
+    # mongo -> redis
+    async def _load_unread_counters(self, user_id: int) -> dict[int, int]:
+        key = self.get_unread_counters_key(user_id)
+        version_key = self.get_unread_counters_version_key(user_id)
+        script = RedisClient.get_script(self.load_unread_counters_script)
+
+        for _ in range(self.unread_counters_load_attempts):
+            async with RedisClient() as client:
+                version = await client.get(version_key)
+
+            async with self.mongo_client(self.unread_counters_collection) as collection:
+                cursor = collection.find({'user_id': user_id, 'count': {"$gt": 0}})
+                counters = {
+                    doc['chat_id']: doc['count']
+                    for doc in await cursor.to_list(None)
+                }
+
+            fields = [self.unread_counters_loaded_field, 1]
+            for chat_id, count in counters.items():
+                fields.extend((chat_id, count))
+            if await script(keys=[key, version_key],
+                            args=[version or '', self.unread_counters_ttl, *fields]):
+                break
+            # счетчик изменился во время чтения, снимок устарел
+
+        return counters
+
+    # redis
+    async def get_unread_counters(self, user_id: int) -> dict[int, int]:
+        if not await self._unread_counters_ready():
+            return await self._aggregate_unread_counters(user_id)
+
+        async with RedisClient() as client:
+            values = await client.hgetall(self.get_unread_counters_key(user_id))
+
+        if not values:
+            return await self._load_unread_counters(user_id)
+
+        return {
+            int(chat_id): int(count)
+            for chat_id, count in values.items()
+            if chat_id.decode('utf-8') != self.unread_counters_loaded_field and int(count) > 0
+        }
+
+    # redis, пока счетчики не заполнены миграцией, считаем по сообщениям
+    async def _unread_counters_ready(self) -> bool:
+        if not MessagesRepo.unread_counters_migrated:
+            async with RedisClient() as client:
+                MessagesRepo.unread_counters_migrated = bool(
+                    await client.exists(self.unread_counters_migration_key))
+        return MessagesRepo.unread_counters_migrated
+
+    # mongo
+    async def _aggregate_unread_counters(self, user_id: int) -> dict[int, int]:
+        async with self.mongo_client(self.messages_collection) as collection:
+            res = await collection.aggregate([
+                {"$match": {"recipient_id": user_id, "is_read": False}},
+                {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}
+            ]).to_list(None)
+        return {r['_id']: r['count'] for r in res}
+
+    # mongo, заполняет счетчики по уже непрочитанным сообщениям
+    async def migrate_unread_counters(self) -> None:
+        await self.run_migration(self.unread_counters_migration_key, self._migrate_unread_counters)
+
+    # $max не затирает инкременты, пришедшие во время агрегации, повторный запуск безопасен
+    async def _migrate_unread_counters(self) -> None:
+        async with self.mongo_client(self.messages_collection) as collection:
+            res = await collection.aggregate([
+                {"$match": {"is_read": False, "recipient_id": {"$ne": None}}},
+                {"$group": {
+                    "_id": {"user_id": "$recipient_id", "chat_id": "$chat_id"},
+                    "count": {"$sum": 1}
+                }}
+            ]).to_list(None)
+
+        if not res:
+            return
+
+        async with self.mongo_client(self.unread_counters_collection) as collection:
+            await collection.bulk_write([
+                UpdateOne(
+                    {'user_id': r['_id']['user_id'],
+                        'chat_id': r['_id']['chat_id']},
+                    {"$max": {'count': r['count']}},
+                    upsert=True
+                )
+                for r in res
+            ], ordered=False)
+
+    # фоном после старта: миграции не держат запуск воркера
+    async def run_migrations(self) -> None:
+        await self.migrate_has_new_messages()
+        await self.migrate_unread_counters()
 
     async def session(self):
         pass
 
     # redis
-    async def store_last_chat_message(self, chat_id: int, message: Message):
+    async def store_last_chat_message(self, chat_id: int, message: Message | MessageRecord):
         if not chat_id or not message:
             return
 
-        if not isinstance(message, Message):
+        if isinstance(message, MessageRecord):
+            payload = message.json_dumps()
+        elif isinstance(message, Message):
+            payload = message.model_dump_json()
+        else:
             return
 
         chat_id = str(chat_id)
 
         async with RedisClient() as client:
-            await client.set(f"{self.last_message_key}{chat_id}", message.model_dump_json())
+            await client.set(f"{self.last_message_key}{chat_id}", payload)
 
     # redis
-    async def get_last_chat_message(self, chat_id: int) -> Union[Message, None]:
+    async def get_last_chat_message(self, chat_id: int) -> Union[MessageRecord, None]:
         if not chat_id:
             return
 
@@ -75,7 +402,24 @@ class MessagesRepo(Repository):
 
         async with RedisClient() as client:
             res = await client.get(f"{self.last_message_key}{chat_id}")
-            return Message.model_validate_json(res.decode("utf-8")) if res else None
+            return MessageRecord.json_loads(res) if res else None
+
+    # redis
+    async def get_last_chat_messages(self, chat_ids: list[int], chunk_size: int = 500) -> dict[int, Message]:
+        chat_ids = [int(chat_id) for chat_id in dict.fromkeys(chat_ids) if chat_id]
+        result = {}
+
+        async with RedisClient() as client:
+            for start in range(0, len(chat_ids), chunk_size):
+                chunk = chat_ids[start:start + chunk_size]
+                values = await client.mget(
+                    [f"{self.last_message_key}{str(chat_id)}" for chat_id in chunk]
+                )
+                for chat_id, value in zip(chunk, values):
+                    if value:
+                        result[chat_id] = Message.model_validate_json(value)
+
+        return result
 
     # mongo
     async def add_message(self, message: Message) -> Union[Message, None]:
@@ -95,6 +439,40 @@ class MessagesRepo(Repository):
 
         return message
 
+    # mongo, ordered=False: ошибка одного документа не валит пачку,
+    # незаписанные сообщения остаются без id и в результат не попадают
+    async def add_messages(self, messages: list[Message | MessageRecord]) -> list[Message | MessageRecord]:
+        messages = [
+            message for message in messages
+            if message and isinstance(message, (Message, MessageRecord))
+        ]
+        if not messages:
+            return []
+
+        now = self.get_now()
+        for message in messages:
+            message.created_at = now
+            if not message.sent_at:
+                message.sent_at = message.created_at
+
+        documents = [
+            message.to_document() if isinstance(message, MessageRecord) else message.model_dump()
+            for message in messages
+        ]
+        failed = set()
+        async with self.mongo_client(self.messages_collection) as collection:
+            try:
+                await collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                failed = {error['index'] for error in e.details.get('writeErrors', [])}
+
+        # _id проставляет драйвер в сами документы до отправки
+        for i, (message, document) in enumerate(zip(messages, documents)):
+            if i not in failed:
+                message.id = str(document['_id'])
+
+        return [message for i, message in enumerate(messages) if i not in failed]
+
     # mongo
     async def edit_message(self, message_id: str, new_text: str) -> Union[Message, None]:
         if not message_id:
@@ -117,12 +495,29 @@ class MessagesRepo(Repository):
             return
 
         async with self.mongo_client(self.messages_collection) as collection:
+            unread = await collection.find(
+                {
+                    "_id": {"$in": [ObjectId(str(m_id)) for m_id in messages_ids]},
+                    "is_read": False
+                },
+                {"chat_id": 1, "recipient_id": 1}
+            ).to_list(None)
+            if not unread:
+                return
+
             records = await collection.update_many(
-                {"_id": {"$in": [ObjectId(str(m_id))
-                                 for m_id in messages_ids]}},
+                {"_id": {"$in": [doc['_id'] for doc in unread]}},
                 {"$set": {"is_read": True}}
             )
 
+        counters = Counter(
+            (int(doc['recipient_id']), int(doc['chat_id']))
+            for doc in unread if doc.get('recipient_id')
+        )
+        await self.incr_unread_counters({
+            key: -amount for key, amount in counters.items()
+        })
+
     # mongo
     async def list_messages(self, chat_id: int, page: int = 1, size: int = 1) -> List[Message]:
         if not chat_id:
@@ -153,7 +548,39 @@ class MessagesRepo(Repository):
         async with self.mongo_client(self.messages_collection) as collection:
             cursor = collection.find({
                 'chat_id': chat_id,
-            }).sort("created_at", -1).skip(offset).limit(size)
+            }).sort(self.history_sort).skip(offset).limit(size)
+
+            return [Message(**doc) for doc in await cursor.to_list(length=size)]
+
+    def get_history_cursor(self, message: Message) -> str:
+        raw = f"{message.created_at.isoformat()}{self.history_cursor_delimeter}{message.id}"
+        return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8')
+
+    def parse_history_cursor(self, cursor: str) -> tuple[datetime.datetime, ObjectId]:
+        raw = base64.urlsafe_b64decode(cursor.encode('utf-8')).decode('utf-8')
+        created_at, message_id = raw.split(self.history_cursor_delimeter)
+        return datetime.datetime.fromisoformat(created_at), ObjectId(message_id)
+
+    # mongo
+    async def list_messages_before(self, chat_id: int, before: str, size: int = 1) -> List[Message]:
+        if not chat_id or not before:
+            return []
+
+        try:
+            chat_id = int(chat_id)
+            size = int(size or 1)
+            created_at, message_id = self.parse_history_cursor(before)
+        except (ValueError, TypeError, InvalidId, binascii.Error):
+            return []
+
+        async with self.mongo_client(self.messages_collection) as collection:
+            cursor = collection.find({
+                'chat_id': chat_id,
+                '$or': [
+                    {'created_at': {'$lt': created_at}},
+                    {'created_at': created_at, '_id': {'$lt': message_id}},
+                ]
+            }).sort(self.history_sort).limit(size)
 
             return [Message(**doc) for doc in await cursor.to_list(length=size)]
 
@@ -194,7 +621,7 @@ class MessagesRepo(Repository):
 
             return [Message(**doc) for doc in await cursor.to_list(length=size)]
 
-    # mongo
+    # redis
     async def count_new_messages_in_chat(self, chat_id: int, user_id: int) -> int:
         if not chat_id or not user_id:
             return 0
@@ -205,14 +632,9 @@ class MessagesRepo(Repository):
         except ValueError:
             return 0
 
-        async with self.mongo_client(self.messages_collection) as collection:
-            return await collection.count_documents({
-                'chat_id': chat_id,
-                'user_id': {"$ne": user_id},
-                'is_read': False
-            })
+        return (await self.get_unread_counters(user_id)).get(chat_id, 0)
 
-    # mongo
+    # redis
     async def count_new_messages_by_chats(self, user_id: int) -> dict:
         if not user_id:
             return {}
@@ -222,15 +644,4 @@ class MessagesRepo(Repository):
         except ValueError:
             return {}
 
-        result = {}
-        async with self.mongo_client(self.messages_collection) as collection:
-            pipeline = [
-                {"$match": {"user_id": {"$ne": user_id}, "is_read": False}},
-                {"$group": {"_id": "$chat_id", "count": {"$sum": 1}}}
-            ]
-
-            res = await collection.aggregate(pipeline).to_list(None)
-            for r in res:
-                result[r['_id']] = r['count']
-
-        return result
+        return await self.get_unread_counters(user_id)
@@ -0,0 +1,173 @@
+import asyncio
+import time
+from src import metrics
+from src.messages.model import MessageRecord
+from src.messages.repo import MessagesRepo
+from src.notifications.repo import NotificationsRepo
+from src.pubsub_manager import RedisClient
+from config import settings
+from monitor import Monitor
+
+
+class MessageWriteError(Exception):
+    pass
+
+
+class MessagesWriter:
+    PUBLISH_ATTEMPTS = 3
+    PUBLISH_BACKOFF = 0.05
+    # маркер разосланной пачки по id ее первого сообщения
+    PUBLISHED_KEY = "messages_published_"
+    PUBLISHED_TTL = 60
+    # метка остановки флашера в очереди
+    STOP = None
+
+    def __init__(self,
+                 messages_repo: MessagesRepo,
+                 channel_name: str,
+                 notifications_repo: NotificationsRepo,
+                 window_ms: int = settings.messages_batch_window_ms,
+                 batch_size: int = settings.messages_batch_size):
+        self.messages_repo = messages_repo
+        self.channel_name = channel_name
+        self.notifications_repo = notifications_repo
+        self.window = window_ms / 1000
+        self.batch_size = batch_size
+        self.queue: asyncio.Queue[tuple[MessageRecord, asyncio.Future]] = asyncio.Queue()
+        self.flusher: asyncio.Task | None = None
+        self.is_active = True
+
+    async def write(self, message: MessageRecord) -> MessageRecord:
+        future = asyncio.get_running_loop().create_future()
+        if not self.is_active:
+            # после close пишем сразу, без флашера
+            await self._flush([(message, future)])
+            return await future
+
+        if not self.flusher or self.flusher.done():
+            self.flusher = asyncio.create_task(self._flush_loop())
+
+        self.queue.put_nowait((message, future))
+        return await future
+
+    def _drain(self, batch: list) -> list:
+        while len(batch) < self.batch_size and not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is self.STOP:
+                # метка остается последней, флашер заберет ее следующим _collect
+                self.queue.put_nowait(item)
+                break
+            batch.append(item)
+        return batch
+
+    async def _collect(self) -> list[tuple[MessageRecord, asyncio.Future]]:
+        item = await self.queue.get()
+        if item is self.STOP:
+            return []
+        batch = [item]
+        # без окна пачка собирается из того, что пришло, пока писалась предыдущая,
+        # поэтому при низкой нагрузке сообщение пишется сразу
+        if self.window and self.queue.empty():
+            await asyncio.sleep(self.window)
+        return self._drain(batch)
+
+    # пачка уходит транзакцией вместе с маркером: если EXEC выполнился, а ответ потерян,
+    # повтор увидит маркер и не задвоит стрим пушей и счетчики непрочитанных
+    async def _publish(self, messages: list[MessageRecord],
+                       unread: dict[tuple[int, int], int], retry: bool = False) -> None:
+        marker = f"{self.PUBLISHED_KEY}{messages[0].id}"
+        async with RedisClient() as r:
+            if retry and await r.exists(marker):
+                return
+            async with r.pipeline(transaction=True) as pipe:
+                await self.messages_repo.cache_unread_counters(pipe, unread)
+                for message in messages:
+                    # msgpack кодируем один раз, одни и те же байты уходят в publish и в стрим пушей
+                    if settings.messages_wire_format == 'msgpack':
+                        payload = message.msgpack_dumps()
+                    else:
+                        payload = message.json_dumps()
+                    pipe.sadd(
+                        self.messages_repo.get_unread_chats_key(
+                            message.recipient_id),
+                        message.chat_id
+                    )
+                    if settings.unread_chats_legacy_keys:
+                        pipe.setnx(
+                            self.messages_repo.get_has_new_messages_key(
+                                message.recipient_id, message.chat_id),
+                            1
+                        )
+                    pipe.publish(
+                        self.channel_name % str(message.chat_id),
+                        payload
+                    )
+                    await self.notifications_repo.add_notification(
+                        pipe, message, payload if isinstance(payload, bytes) else None)
+                pipe.set(marker, 1, ex=self.PUBLISHED_TTL)
+                await pipe.execute()
+
+    async def _flush(self, batch: list[tuple[MessageRecord, asyncio.Future]]) -> None:
+        metrics.messages_batch_size.observe(len(batch))
+        try:
+            start = time.perf_counter()
+            messages = await self.messages_repo.add_messages(
+                [message for message, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        # сообщение в монге, отправитель получает ответ независимо от рассылки
+        for message, future in batch:
+            if future.done():
+                continue
+            if message.id:
+                future.set_result(message)
+            else:
+                future.set_exception(MessageWriteError("Сообщение не записано"))
+        if not messages:
+            return
+
+        unread = self.messages_repo.count_unread(messages)
+        try:
+            await self.messages_repo.save_unread_counters(unread)
+        except Exception as e:
+            Monitor.log_nowait(e, level=Monitor.ERROR)
+        metrics.message_stage_latency.labels('mongo_insert').observe(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for attempt in range(1, self.PUBLISH_ATTEMPTS + 1):
+            try:
+                await self._publish(messages, unread, retry=attempt > 1)
+                break
+            except Exception as e:
+                if attempt == self.PUBLISH_ATTEMPTS:
+                    Monitor.log_nowait(
+                        "Пачка из %s сообщений записана, но не разослана: %s" % (len(messages), e),
+                        level=Monitor.ERROR)
+                    return
+                await asyncio.sleep(self.PUBLISH_BACKOFF * 2 ** (attempt - 1))
+        metrics.message_stage_latency.labels('redis_publish').observe(time.perf_counter() - start)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            batch = await self._collect()
+            if not batch:
+                return
+            await self._flush(batch)
+
+    # флашер дописывает текущую пачку и выходит на метке остановки
+    async def close(self) -> None:
+        self.is_active = False
+        if self.flusher and not self.flusher.done():
+            self.queue.put_nowait(self.STOP)
+            await self.flusher
+        self.flusher = None
+
+        batch = self._drain([])
+        while batch:
+            await self._flush(batch)
+            batch = self._drain([])
@@ -14,11 +14,71 @@ ws_bytes_in = Counter(
 )
 
 
-def get_range(start: float = 0.150, stop: int = 0.750, step: float = 0.050) -> Generator[float, None, None]:
-    while start < stop:
-        yield round(start, 3)
-        start += step
+def get_range(start: float = 0.150, stop: float = 0.750, step: float = 0.050) -> Generator[float, None, None]:
+    # шаг считается от начала, чтобы не копить ошибку округления
+    i = 0
+    while start + i * step < stop:
+        yield round(start + i * step, 3)
+        i += 1
 
 
-ws_time_to_process = Histogram("ws_time_to_process", "Время на выполнение запроса",
-                               buckets=(*list(get_range(0, 300, 10)), float('inf')))
+# все длительности в секундах
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.0075, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, float('inf'))
+
+ws_time_to_process = Histogram("ws_time_to_process", "Время отправки пакета в сокет, с",
+                               buckets=LATENCY_BUCKETS)
+
+# receive - от кадра клиента до записи пачки, mongo_insert / redis_publish - запись пачки,
+# fanout - от получения из pub/sub до отправки в сокет, handle_message - огоньки отправителя,
+# push_dispatch - отправка пуша на все устройства получателя
+message_stage_latency = Histogram("message_stage_latency", "Время этапа обработки сообщения, с",
+                                  ["stage"], buckets=LATENCY_BUCKETS)
+
+message_e2e_latency = Histogram("message_e2e_latency", "Время от sent_at клиента до отправки получателю, с",
+                                buckets=(*list(get_range(0.025, 0.25, 0.025)), 0.5, 1, 2.5, 5, 10, float('inf')))
+
+messages_batch_size = Histogram("messages_batch_size", "Количество сообщений в пачке записи",
+                                buckets=(1, 2, 5, 10, 25, 50, 100, 250, float('inf')))
+
+redis_round_trips = Counter(
+    "redis_round_trips", "Количество запросов в редис (пайплайн - один запрос)", ["command"]
+)
+
+mongo_round_trips = Counter(
+    "mongo_round_trips", "Количество команд в монгу", ["command"]
+)
+
+ws_send_queue_depth = Histogram("ws_send_queue_depth", "Глубина очереди отправки сокета",
+                                buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, float('inf')))
+
+ws_send_queue_drops = Counter(
+    "ws_send_queue_drops", "Количество кадров, сброшенных из очереди отправки", ["policy"]
+)
+
+ws_send_queue_overflows = Counter(
+    "ws_send_queue_overflows", "Количество сокетов, закрытых из-за переполнения очереди"
+)
+
+fcm_requests_in_flight = Gauge(
+    "fcm_requests_in_flight", "Количество запросов в firebase в процессе отправки"
+)
+
+fcm_request_latency = Histogram("fcm_request_latency", "Время запроса в firebase, с",
+                                buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, float('inf')))
+
+monitor_dropped_events = Counter(
+    "monitor_dropped_events", "Количество событий, не попавших ни в loki, ни на диск", ["reason"]
+)
+
+monitor_spilled_events = Counter(
+    "monitor_spilled_events", "Количество событий, записанных на диск, пока loki недоступен"
+)
+
+monitor_replayed_events = Counter(
+    "monitor_replayed_events", "Количество событий, досланных в loki с диска"
+)
+
+monitor_buffer_depth = Gauge(
+    "monitor_buffer_depth", "Количество событий в буфере монитора"
+)
@@ -1,12 +1,15 @@
+import os
+import socket
 import time
 import asyncio
 import redis
-from httpx import AsyncClient
-from src.notifications.google_auth import get_access_token
+from src.notifications.google_auth import token_provider
 from src.notifications.firebase import send_notification
-from src.notifications.repo import DeviceRepo
+from src.notifications.repo import DeviceRepo, NotificationsRepo
+from src.presence.repo import PresenceRepo
 from src.notifications.device import Device
 from src.pubsub_manager import RedisClient
+from src import metrics
 from src.messages.model import Message
 from config import settings
 from monitor import Monitor
@@ -15,19 +18,37 @@ from monitor import Monitor
 class Consumer:
     GROUP_NAME = 'mygroup'
     STREAN_NAME = 'notifications'
+    DLQ_STREAM_NAME = 'notifications:dlq'
+    ERROR_DELAY = 1
+    CLOSE_TIMEOUT = 5
+    # потребители без сообщений в PEL, простаивающие дольше суток, удаляются из группы
+    CONSUMER_IDLE_MS = 24 * 60 * 60 * 1000
 
-    def __init__(self, consumers_amount: int = 3):
+    def __init__(self,
+                 consumers_amount: int = 3,
+                 batch_size: int = settings.notifications_batch_size,
+                 block_ms: int = settings.notifications_block_ms,
+                 max_concurrent_sends: int = settings.notifications_max_concurrent_sends,
+                 max_attempts: int = settings.notifications_max_attempts,
+                 max_deliveries: int = settings.notifications_max_deliveries):
         super().__init__()
-        self.access_token = None
-        self.token_created_at: int = 0
         self.device_repo: DeviceRepo = DeviceRepo()
+        self.notifications_repo: NotificationsRepo = NotificationsRepo()
+        self.presence_repo: PresenceRepo = PresenceRepo()
         self.is_active = True
         self.consumers_amount = consumers_amount
-
-    async def _update_token(self) -> None:
-        if (time.time() - self.token_created_at) >= settings.google_jwt_ttl:
-            self.access_token = await get_access_token()
-            self.token_created_at = time.time()
+        self.batch_size = batch_size
+        self.block_ms = block_ms
+        self.max_attempts = max_attempts
+        self.max_deliveries = max_deliveries
+        self.semaphore = asyncio.Semaphore(max_concurrent_sends)
+        self.batches = asyncio.Semaphore(
+            settings.notifications_max_batches_in_flight)
+        # имя должно быть уникальным между репликами, иначе PEL упавшей реплики не найти
+        self.consumer_prefix = f'{socket.gethostname()}-{os.getpid()}'
+        # цикл loop держит задачи только слабыми ссылками
+        self.task: asyncio.Task | None = None
+        self.tasks: set[asyncio.Task] = set()
 
     async def _create_group(self):
         async with RedisClient() as r:
@@ -40,45 +61,262 @@ class Consumer:
     async def main(self):
         await self._create_group()
 
-        await asyncio.gather(*[self._consume(f'consumer{i}') for i in range(1, self.consumers_amount + 1)])
+        consumers = [
+            f'{self.consumer_prefix}-{i}' for i in range(1, self.consumers_amount + 1)
+        ]
+        await asyncio.gather(
+            *[self._consume(consumer_name) for consumer_name in consumers],
+            self._reclaim(consumers[0])
+        )
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.main())
+
+    # пачки в обработке дорабатывают до таймаута, остальные отменяются:
+    # неподтвержденные записи заберет _reclaim другой реплики
+    async def close(self, timeout: float = CLOSE_TIMEOUT) -> None:
+        self.is_active = False
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+        if self.tasks:
+            _, pending = await asyncio.wait(set(self.tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    @staticmethod
+    def _is_retryable(status: int | None) -> bool:
+        return status is None or status == 429 or status >= 500
+
+    @staticmethod
+    def _get_backoff(attempt: int) -> float:
+        return min(
+            settings.notifications_retry_backoff * 2 ** (attempt - 1),
+            settings.notifications_retry_backoff_max
+        )
+
+    async def _send(self, device: Device, message: Message, count: int = 1) -> bool:
+        for attempt in range(1, self.max_attempts + 1):
+            access_token = await token_provider.get_token()
+            # без токена запрос не отправляем, ждем следующего обновления
+            if access_token:
+                async with self.semaphore:
+                    status = await send_notification(
+                        device.token,
+                        title=f'Новое сообщение' if count == 1 else f'Новые сообщения ({count})',
+                        text=message.text,
+                        data={
+                            'user_id': str(message.user_id),
+                            'chat_id': str(message.chat_id),
+                            'created_at': str(message.created_at),
+                            'id': str(message.id),
+                            'recipient_id': str(message.recipient_id),
+                            'count': str(count)
+                        },
+                        access_token=access_token,
+                        collapse_key=f'chat_{message.chat_id}'
+                    )
+
+                if status == 200:
+                    return True
+                if status == 401:
+                    token_provider.invalidate(access_token)
+                elif not self._is_retryable(status):
+                    return False
+
+            if attempt < self.max_attempts:
+                await asyncio.sleep(self._get_backoff(attempt))
+
+        return False
+
+    async def _dead_letter(self, message_data: dict, reason: str, tokens: list[str] | None = None) -> None:
+        async with RedisClient() as r:
+            await r.xadd(
+                self.DLQ_STREAM_NAME,
+                {
+                    **message_data,
+                    'dlq_reason': reason,
+                    'dlq_tokens': ','.join(tokens or [])
+                },
+                maxlen=settings.notifications_dlq_maxlen,
+                approximate=True
+            )
+
+    # id записи стрима задают часы редиса, поэтому и текущее время берем у него
+    async def _get_redis_time_ms(self) -> int:
+        async with RedisClient() as r:
+            seconds, microseconds = await r.time()
+        return seconds * 1000 + microseconds // 1000
+
+    async def _wait_window(self, message_id: bytes, now_ms: int) -> None:
+        created_at_ms = int(message_id.split(b'-')[0])
+        delay = (created_at_ms + self.notifications_repo.window_ms - now_ms) / 1000
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _deliver(self, message_id: bytes, message_data: dict, message: Message,
+                       devices: list[Device], now_ms: int) -> bytes:
+        if not devices:
+            return message_id
+
+        # сообщения одного окна для пары (получатель, чат) уходят одним пушем
+        await self._wait_window(message_id, now_ms)
+        message, count = await self.notifications_repo.get_window(message)
+
+        if not await self.presence_repo.is_connected(message.recipient_id, message.chat_id):
+            start = time.perf_counter()
+            results = await asyncio.gather(*[
+                self._send(device, message, count) for device in devices
+            ])
+            metrics.message_stage_latency.labels('push_dispatch').observe(time.perf_counter() - start)
+            failed = [
+                device.token for device, is_sent in zip(devices, results) if not is_sent
+            ]
+            if failed:
+                await self._dead_letter(message_data, 'send_failed', failed)
+
+        await self.notifications_repo.close_window(message, count)
+        return message_id
+
+    # возвращает id записей, которые обработаны и могут быть подтверждены
+    async def _handle_batch(self, entries: list[tuple[bytes, dict | None]]) -> list[bytes]:
+        processed: list[bytes] = []
+        messages: list[tuple[bytes, dict, Message]] = []
+
+        for message_id, message_data in entries:
+            # запись уже удалена из стрима, в PEL остался только id
+            if not message_data:
+                processed.append(message_id)
+                continue
+            try:
+                messages.append(
+                    (message_id, message_data, Message.deserialize(message_data)))
+            except Exception as e:
+                await Monitor.log(str(e), unknown=True)
+                await self._dead_letter(message_data, 'invalid_message')
+                processed.append(message_id)
+
+        users_devices = await self.device_repo.get_users_devices({
+            message.recipient_id for _, _, message in messages if message.recipient_id
+        })
+        now_ms = await self._get_redis_time_ms() if messages else 0
+
+        results = await asyncio.gather(*[
+            self._deliver(message_id, message_data, message,
+                          users_devices.get(message.recipient_id, []), now_ms)
+            for message_id, message_data, message in messages
+        ], return_exceptions=True)
+
+        for result in results:
+            if isinstance(result, Exception):
+                await Monitor.log(str(result), unknown=True)
+                continue
+            processed.append(result)
+
+        return processed
+
+    async def _ack(self, messages_ids: list[bytes]) -> None:
+        if not messages_ids:
+            return
+
+        async with RedisClient() as r:
+            async with r.pipeline(transaction=False) as pipe:
+                pipe.xack(self.STREAN_NAME, self.GROUP_NAME, *messages_ids)
+                pipe.xdel(self.STREAN_NAME, *messages_ids)
+                await pipe.execute()
 
     async def _consume(self, consumer_name: str):
         async with RedisClient() as r:
             while self.is_active:
                 try:
-                    await self._update_token()
                     try:
-                        messages = await r.xreadgroup(self.GROUP_NAME, consumer_name, streams={self.STREAN_NAME: '>'}, count=1, noack=True)
+                        messages = await r.xreadgroup(
+                            self.GROUP_NAME, consumer_name,
+                            streams={self.STREAN_NAME: '>'},
+                            count=self.batch_size,
+                            block=self.block_ms
+                        )
                     except redis.exceptions.ResponseError:
                         await self._create_group()
                         continue
 
-                    if messages:
-                        stream, message = messages[0]
-                        message_id, message_data = message[0]
-                        message = Message.deserialize(message_data)
-                        user_devices = await self.device_repo.get_user_devices(
-                            message.recipient_id
-                        ) if message.recipient_id else []
-                        for device in user_devices:
-                            try:
-                                await send_notification(
-                                    device.token,
-                                    title=f'Новое сообщение',
-                                    text=message.text,
-                                    data={
-                                        'user_id': str(message.user_id),
-                                        'chat_id': str(message.chat_id),
-                                        'created_at': str(message.created_at),
-                                        'id': str(message.id),
-                                        'recipient_id': str(message.recipient_id)
-                                    },
-                                    access_token=self.access_token
-                                )
-                            except Exception as e:
-                                await Monitor.log(str(e), unknown=True)
-                                continue
-                        await r.xdel(self.STREAN_NAME, message_id)
+                    if not messages:
+                        continue
+
+                    stream, entries = messages[0]
+                    # пачка ждет окно склейки в фоне, чтобы не задерживать чтение стрима
+                    await self.batches.acquire()
+                    task = asyncio.create_task(self._process_batch(entries))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
                 except Exception as e:
                     await Monitor.log(str(e), unknown=True)
-                await asyncio.sleep(0.1)
+                    await asyncio.sleep(self.ERROR_DELAY)
+
+    async def _process_batch(self, entries: list[tuple[bytes, dict | None]]) -> None:
+        try:
+            await self._ack(await self._handle_batch(entries))
+        except Exception as e:
+            await Monitor.log(str(e), unknown=True)
+        finally:
+            self.batches.release()
+
+    async def _claim_stale(self, consumer_name: str) -> None:
+        start_id = '0-0'
+        async with RedisClient() as r:
+            while True:
+                start_id, entries, *_ = await r.xautoclaim(
+                    self.STREAN_NAME, self.GROUP_NAME, consumer_name,
+                    min_idle_time=settings.notifications_reclaim_min_idle_ms,
+                    start_id=start_id,
+                    count=self.batch_size
+                )
+                entries = [entry for entry in entries if entry[0]]
+                if entries:
+                    await Monitor.log(
+                        f"Забрано зависших уведомлений: {len(entries)}")
+                    await self._ack(await self._handle_reclaimed(entries))
+
+                # пустая страница не значит конец PEL, идем до нулевого курсора
+                if start_id in (b'0-0', '0-0'):
+                    return
+
+    async def _handle_reclaimed(self, entries: list[tuple[bytes, dict | None]]) -> list[bytes]:
+        async with RedisClient() as r:
+            pending = await r.xpending_range(
+                self.STREAN_NAME, self.GROUP_NAME,
+                min=entries[0][0], max=entries[-1][0], count=len(entries)
+            )
+        deliveries = {
+            p['message_id']: p['times_delivered'] for p in pending
+        }
+
+        # сообщения, которые раз за разом роняют обработку, уходят в DLQ без отправки
+        processed, retry = [], []
+        for message_id, message_data in entries:
+            if message_data and deliveries.get(message_id, 0) > self.max_deliveries:
+                await self._dead_letter(message_data, 'max_deliveries')
+                processed.append(message_id)
+            else:
+                retry.append((message_id, message_data))
+
+        return processed + await self._handle_batch(retry)
+
+    async def _remove_idle_consumers(self) -> None:
+        async with RedisClient() as r:
+            for consumer in await r.xinfo_consumers(self.STREAN_NAME, self.GROUP_NAME):
+                if consumer['pending'] == 0 and consumer['idle'] > self.CONSUMER_IDLE_MS:
+                    await r.xgroup_delconsumer(
+                        self.STREAN_NAME, self.GROUP_NAME, consumer['name'])
+
+    async def _reclaim(self, consumer_name: str):
+        while self.is_active:
+            await asyncio.sleep(settings.notifications_reclaim_interval)
+            try:
+                await self._claim_stale(consumer_name)
+                await self._remove_idle_consumers()
+            except Exception as e:
+                await Monitor.log(str(e), unknown=True)
@@ -1,43 +1,97 @@
 import json
-from httpx import AsyncClient
-from httpx import ReadTimeout, ConnectTimeout
+import time
+from httpx import AsyncClient, Limits, Timeout
+from httpx import TimeoutException, TransportError
 from config import settings
 from monitor import Monitor
+from src import metrics
 
 
-async def send_notification(device_token: str, title: str, text: str, data: dict[str, str], access_token: str):
+class FirebaseClient:
+    client: AsyncClient | None = None
+
+    @classmethod
+    async def connect(cls):
+        if not cls.client:
+            cls.client = AsyncClient(
+                http2=settings.firebase_http2,
+                limits=Limits(
+                    max_connections=settings.firebase_max_connections,
+                    max_keepalive_connections=settings.firebase_max_keepalive_connections,
+                    keepalive_expiry=settings.firebase_keepalive_expiry
+                ),
+                timeout=Timeout(
+                    settings.firebase_timeout,
+                    connect=settings.firebase_connect_timeout
+                )
+            )
+        await Monitor.log("Подключение к firebase открыто")
+
+    @classmethod
+    async def disconnect(cls):
+        if cls.client:
+            await cls.client.aclose()
+            cls.client = None
+        await Monitor.log("Подключение к firebase закрыто")
+
+
+# возвращает статус ответа firebase или None, если запрос не дошел
+async def send_notification(device_token: str, title: str, text: str, data: dict[str, str], access_token: str,
+                            collapse_key: str | None = None) -> int | None:
     if not data:
         data = {}
     text, title = str(text), title
 
-    async with AsyncClient() as client:
-        try:
-            response = await client.post(
-                settings.firebase_send_address,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {access_token}',
-                },
-                json={
-                    'message': {
-                        'token': device_token,
-                        'notification': {
-                            'title': title,
-                            'body': text,
-                        },
-                        "apns": {
-                            "payload": {
-                                "aps": {
-                                    "sound": "default"
-                                }
+    if not FirebaseClient.client:
+        await FirebaseClient.connect()
+
+    metrics.fcm_requests_in_flight.inc()
+    start = time.perf_counter()
+    try:
+        response = await FirebaseClient.client.post(
+            settings.firebase_send_address,
+            headers={
+                'Content-Type': 'application/json',
+                'Authorization': f'Bearer {access_token}',
+            },
+            json={
+                'message': {
+                    'token': device_token,
+                    'notification': {
+                        'title': title,
+                        'body': text,
+                    },
+                    "apns": {
+                        "headers": {
+                            "apns-collapse-id": collapse_key
+                        } if collapse_key else {},
+                        "payload": {
+                            "aps": {
+                                "sound": "default"
                             }
-                        },
-                        'data': data
-                    }
-                })
-        except (ReadTimeout, ConnectTimeout):
-            await Monitor.log("Таймаут подключения к firebase")
-            return
-        if response.status_code != 200:
-            await Monitor.log(response.text)
-        await Monitor.log("Уведомление отправлено на устройство")
+                        }
+                    },
+                    "android": {
+                        "collapse_key": collapse_key,
+                        "notification": {
+                            "tag": collapse_key
+                        }
+                    } if collapse_key else {},
+                    'data': data
+                }
+            })
+    except TimeoutException:
+        Monitor.log_nowait("Таймаут подключения к firebase")
+        return
+    except TransportError as e:
+        Monitor.log_nowait(e, level=Monitor.ERROR)
+        return
+    finally:
+        metrics.fcm_requests_in_flight.dec()
+        metrics.fcm_request_latency.observe(time.perf_counter() - start)
+
+    if response.status_code != 200:
+        Monitor.log_nowait(response.text)
+        return response.status_code
+    Monitor.log_nowait("Уведомление отправлено на устройство")
+    return response.status_code
@@ -1,48 +1,114 @@
+import asyncio
 import time
 from typing import Union
 import json
 import jwt
-from httpx import AsyncClient
 import aiofile
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
 from config import settings
 from monitor import Monitor
+from src.notifications.firebase import FirebaseClient
 
 
-async def _create_jwt(
-        conf_path: str = settings.google_conf_path,
-        ttl_sec: int = settings.google_jwt_ttl):
-    async with aiofile.async_open(conf_path) as file:
-        config = json.loads(await file.read())
-
-    now = int(time.time())
-    payload = {
-        'iss': config['client_email'],
-        'sub': config['client_email'],
-        'aud': 'https://oauth2.googleapis.com/token',
-        'iat': now,
-        'exp': now + ttl_sec,
-        'scope': 'https://www.googleapis.com/auth/firebase.messaging'
-    }
-    additional_headers = {
-        'kid': config['private_key_id']
-    }
-    signed_jwt = jwt.encode(
-        payload, config['private_key'], headers=additional_headers, algorithm='RS256')
-    return signed_jwt
+class GoogleTokenProvider:
+    REFRESH_RATIO = 0.8
+    RETRY_DELAY = 5
 
+    def __init__(self,
+                 conf_path: str = settings.google_conf_path,
+                 ttl_sec: int = settings.google_jwt_ttl):
+        self.conf_path = conf_path
+        self.ttl_sec = ttl_sec
+        self.config: dict | None = None
+        self.private_key = None
+        self.access_token: str | None = None
+        self.expires_at: float = 0
+        self.refresh_task: asyncio.Task | None = None
+        self.is_active = True
 
-async def get_access_token() -> Union[str, None]:
-    async with AsyncClient() as client:
-        response = await client.post(
+    async def _load_config(self) -> None:
+        if self.config:
+            return
+        async with aiofile.async_open(self.conf_path) as file:
+            self.config = json.loads(await file.read())
+        self.private_key = load_pem_private_key(
+            self.config['private_key'].encode('utf-8'), password=None)
+
+    async def _create_jwt(self) -> str:
+        await self._load_config()
+
+        now = int(time.time())
+        payload = {
+            'iss': self.config['client_email'],
+            'sub': self.config['client_email'],
+            'aud': 'https://oauth2.googleapis.com/token',
+            'iat': now,
+            'exp': now + self.ttl_sec,
+            'scope': 'https://www.googleapis.com/auth/firebase.messaging'
+        }
+        additional_headers = {
+            'kid': self.config['private_key_id']
+        }
+        return jwt.encode(
+            payload, self.private_key, headers=additional_headers, algorithm='RS256')
+
+    async def _refresh(self) -> Union[str, None]:
+        if not FirebaseClient.client:
+            await FirebaseClient.connect()
+
+        response = await FirebaseClient.client.post(
             settings.google_token_url,
             headers={'Content-Type': 'application/x-www-form-urlencoded'},
             data={
                 'grant_type': 'urn:ietf:params:oauth:grant-type:jwt-bearer',
-                'assertion': await _create_jwt()
+                'assertion': await self._create_jwt()
             }
         )
 
-    if response.status_code != 200:
-        await Monitor.log(response.text)
-        return
-    return response.json().get("access_token")
+        if response.status_code != 200:
+            await Monitor.log(response.text)
+            return
+
+        token = response.json()
+        self.access_token = token.get("access_token")
+        self.expires_at = time.time() + int(token.get("expires_in", self.ttl_sec))
+        return self.access_token
+
+    # одновременные вызовы ждут одно и то же обновление
+    async def refresh(self) -> Union[str, None]:
+        if not self.refresh_task or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._refresh())
+        return await asyncio.shield(self.refresh_task)
+
+    async def get_token(self) -> Union[str, None]:
+        if self.access_token and time.time() < self.expires_at:
+            return self.access_token
+        return await self.refresh()
+
+    # вызывается после 401 от firebase, токен сбрасывается, только если его еще не обновили
+    def invalidate(self, access_token: str | None) -> None:
+        if access_token == self.access_token:
+            self.access_token = None
+            self.expires_at = 0
+
+    async def main(self):
+        while self.is_active:
+            try:
+                token = await self.refresh()
+            except Exception as e:
+                await Monitor.log(str(e), unknown=True)
+                token = None
+
+            if not token:
+                await asyncio.sleep(self.RETRY_DELAY)
+                continue
+
+            ttl = self.expires_at - time.time()
+            await asyncio.sleep(max(ttl * self.REFRESH_RATIO, self.RETRY_DELAY))
+
+
+token_provider = GoogleTokenProvider()
+
+
+async def get_access_token() -> Union[str, None]:
+    return await token_provider.get_token()
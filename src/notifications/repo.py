@@ -1,5 +1,7 @@
 from src.pubsub_manager import RedisClient
 from src.notifications.device import Device
+from src.messages.model import Message, MessageRecord, PAYLOAD_FIELD
+from config import settings
 
 
 class DeviceRepo:
@@ -18,3 +20,128 @@ class DeviceRepo:
                 )
                 for t in await r.smembers(self.token_key % str(user_id))
             ]
+
+    async def get_users_devices(self, users_ids: set[int]) -> dict[int, list[Device]]:
+        users_ids = list(users_ids)
+        if not users_ids:
+            return {}
+
+        async with RedisClient() as r:
+            async with r.pipeline(transaction=False) as pipe:
+                for user_id in users_ids:
+                    pipe.smembers(self.token_key % str(user_id))
+                tokens = await pipe.execute()
+
+        return {
+            user_id: [
+                Device(
+                    user_id=user_id,
+                    token=t
+                )
+                for t in user_tokens
+            ]
+            for user_id, user_tokens in zip(users_ids, tokens)
+        }
+
+
+class NotificationsRepo:
+    stream_name: str = 'notifications'
+    window_key: str = 'notifications_window_%s:%s'
+    count_field: str = 'count'
+
+    # в стрим попадает только первое сообщение окна, остальные копятся в ключе окна
+    coalesce_script = """
+        local count = redis.call('HINCRBY', KEYS[1], ARGV[2], 1)
+        redis.call('HSET', KEYS[1], unpack(ARGV, 3))
+        if count == 1 then
+            redis.call('PEXPIRE', KEYS[1], ARGV[1])
+            redis.call('XADD', KEYS[2], '*', unpack(ARGV, 3))
+        end
+        return count
+    """
+
+    # сообщения, пришедшие во время отправки пуша, открывают новое окно с остатком счетчика
+    close_window_script = """
+        local count = tonumber(redis.call('HGET', KEYS[1], ARGV[2]) or '0')
+        local window = redis.call('HGETALL', KEYS[1])
+        local fields = {}
+        for i = 1, #window, 2 do
+            if window[i] ~= ARGV[2] then
+                table.insert(fields, window[i])
+                table.insert(fields, window[i + 1])
+            end
+        end
+        if count <= tonumber(ARGV[1]) or #fields == 0 then
+            redis.call('DEL', KEYS[1])
+            return 0
+        end
+        count = count - tonumber(ARGV[1])
+        redis.call('HSET', KEYS[1], ARGV[2], count)
+        redis.call('PEXPIRE', KEYS[1], ARGV[3])
+        redis.call('XADD', KEYS[2], '*', unpack(fields))
+        return count
+    """
+
+    def __init__(self, window_ms: int = settings.notifications_coalesce_window_ms):
+        self.window_ms = window_ms
+
+    # ключ окна живет дольше окна на случай, если консьюмер отстает
+    @property
+    def window_ttl_ms(self) -> int:
+        return self.window_ms * 10 + 60000
+
+    def get_window_key(self, recipient_id: int, chat_id: int) -> str:
+        return self.window_key % (str(recipient_id), str(chat_id))
+
+    def get_fields(self, message: Message | MessageRecord, payload: bytes | None = None) -> dict:
+        if settings.messages_wire_format == 'msgpack':
+            return {PAYLOAD_FIELD: payload if payload is not None else message.msgpack_dumps()}
+        if isinstance(message, MessageRecord):
+            return message.to_fields()
+        return message.serialize()
+
+    async def add_notification(self, pipe, message: Message | MessageRecord, payload: bytes | None = None) -> None:
+        fields = self.get_fields(message, payload)
+
+        if not self.window_ms or not message.recipient_id:
+            pipe.xadd(self.stream_name, fields)
+            return
+
+        fields = [item for field in fields.items() for item in field]
+
+        await RedisClient.get_script(self.coalesce_script)(
+            keys=[
+                self.get_window_key(message.recipient_id, message.chat_id),
+                self.stream_name
+            ],
+            args=[self.window_ttl_ms, self.count_field, *fields],
+            client=pipe
+        )
+
+    # последнее сообщение окна и количество сообщений в нем; окно закрывается
+    # только после отправки через close_window, чтобы падение не теряло счетчик
+    async def get_window(self, message: Message) -> tuple[Message, int]:
+        if not self.window_ms or not message.recipient_id:
+            return message, 1
+
+        async with RedisClient() as r:
+            window = await r.hgetall(
+                self.get_window_key(message.recipient_id, message.chat_id))
+
+        if not window:
+            return message, 1
+
+        count = int(window.pop(self.count_field.encode('utf-8'), 1))
+        return Message.deserialize(window), count
+
+    async def close_window(self, message: Message, count: int) -> None:
+        if not self.window_ms or not message.recipient_id:
+            return
+
+        await RedisClient.get_script(self.close_window_script)(
+            keys=[
+                self.get_window_key(message.recipient_id, message.chat_id),
+                self.stream_name
+            ],
+            args=[count, self.count_field, self.window_ttl_ms]
+        )
@@ -1,7 +1,7 @@
 
 from enum import Enum
 from typing import Any
-from pydantic import BaseModel, computed_field, model_validator
+from pydantic import BaseModel, Field, computed_field, model_validator
 from datetime import datetime, timezone, timedelta
 
 
@@ -42,7 +42,10 @@ class UserAction(BaseModel):
     u_id: int
     action: Action
     message: OnboardingMessage | None
-    created_at: datetime = datetime.now(tzinfo)
+    created_at: datetime = Field(default_factory=lambda: datetime.now(tzinfo))
+    # шаг сценария, на котором выполнено действие; задается репозиторием при сохранении,
+    # у действий, сохраненных до курсоров, его нет
+    step: int | None = None
 
     @model_validator(mode='after')
     def validate_message(self):
@@ -54,3 +57,10 @@ class UserAction(BaseModel):
 class Onboarding(BaseModel):
     chat: list[BlockMessage]
     next_action: NextAction | None = None
+
+
+# прогресс пользователя по сценарию: номер шага
+class OnboardingCursor(BaseModel):
+    u_id: int
+    step: int = 0
+    updated_at: datetime = Field(default_factory=lambda: datetime.now(tzinfo))
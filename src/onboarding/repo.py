@@ -1,3 +1,8 @@
+import time
+from datetime import datetime
+from collections import defaultdict
+from pymongo import IndexModel, ReturnDocument
+from pymongo.errors import DuplicateKeyError
 from src.repository import Repository
 from .models import (
     UserAction,
@@ -6,20 +11,93 @@ from .models import (
     AssistantMessage,
     BlockMessage,
     Action,
-    OnboardingMessage
+    OnboardingMessage,
+    OnboardingCursor
 )
 from src.pubsub_manager import RedisClient
 
 
 class OnboardingRepo(Repository):
     assistant_messages_key = "asisstant_messages"
+    # сообщения ассистента меняются только при деплое, держим разобранными в памяти процесса
+    assistant_messages_ttl = 60
+    assistant_messages: dict[int, list[AssistantMessage]] | None = None
+    assistant_messages_loaded_at = 0.0
 
-    async def save_action(self, action: UserAction) -> UserAction:
-        async with self.mongo_client(self.onboardings_collection) as collection:
-            await collection.insert_one(
-                action.model_dump()
+    indexes = {
+        Repository.onboardings_collection: [
+            IndexModel([("u_id", 1), ("created_at", 1)]),
+            IndexModel([("u_id", 1), ("action", 1), ("created_at", 1)]),
+            IndexModel([("u_id", 1), ("step", 1)],
+                       unique=True,
+                       partialFilterExpression={"step": {"$exists": True}}),
+        ],
+        Repository.onboarding_cursors_collection: [
+            IndexModel([("u_id", 1)], unique=True),
+        ]
+    }
+
+    # mongo, шаг занимает само действие: уникальный индекс (u_id, step) не пустит второе
+    # действие на тот же шаг. Курсор только догоняет сохраненные действия через $max,
+    # так что падение между записями чинится следующим запросом.
+    # None - шаг уже занят параллельным запросом
+    async def save_action(self, action: UserAction, step: int) -> OnboardingCursor | None:
+        action.step = step
+        try:
+            async with self.mongo_client(self.onboardings_collection) as collection:
+                await collection.insert_one(action.model_dump())
+        except DuplicateKeyError:
+            await self._advance_cursor(action.u_id, step)
+            return None
+
+        return await self._advance_cursor(action.u_id, step, action.created_at)
+
+    # mongo
+    async def _advance_cursor(self, user_id: int, step: int,
+                              updated_at: datetime | None = None) -> OnboardingCursor:
+        update = {'$max': {'step': step + 1}}
+        if updated_at:
+            update['$set'] = {'updated_at': updated_at}
+
+        async with self.mongo_client(self.onboarding_cursors_collection) as cursors:
+            cursor = await cursors.find_one_and_update(
+                {'u_id': user_id},
+                update,
+                projection={'_id': 0},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
             )
-            return action
+        return OnboardingCursor(**cursor)
+
+    # mongo
+    async def get_cursor(self, user_id: int) -> OnboardingCursor:
+        async with self.mongo_client(self.onboarding_cursors_collection) as cursors:
+            cursor = await cursors.find_one({'u_id': user_id}, {'_id': 0})
+        if cursor:
+            return OnboardingCursor(**cursor)
+        return await self._migrate_cursor(user_id)
+
+    # mongo, курсор для пользователей, начавших онбординг до появления курсоров
+    async def _migrate_cursor(self, user_id: int) -> OnboardingCursor:
+        user_actions = await self.get_user_actions(user_id)
+        cursor = OnboardingCursor(
+            u_id=user_id,
+            step=len(user_actions)
+        )
+
+        async with self.mongo_client(self.onboarding_cursors_collection) as cursors:
+            try:
+                await cursors.update_one(
+                    {'u_id': user_id},
+                    {'$setOnInsert': cursor.model_dump()},
+                    upsert=True
+                )
+            except DuplicateKeyError:
+                pass
+            # при гонке побеждает курсор, записанный первым
+            existing = await cursors.find_one({'u_id': user_id}, {'_id': 0})
+
+        return OnboardingCursor(**existing) if existing else cursor
 
     async def get_user_actions(self, user_id: int, action: Action | None = None) -> UserAction:
         params = {
@@ -55,14 +133,19 @@ class OnboardingRepo(Repository):
         user_actions = await self.get_user_actions(user_id)
         assistant_messages = await self.get_assistant_message()
 
+        # действия без шага сохранены до курсоров подряд, их шаг - позиция
+        actions_by_step = {
+            i if user_action.step is None else user_action.step: user_action
+            for i, user_action in enumerate(user_actions)
+        }
+
         chat: list[BlockMessage] = []
         last_block: int = 0
 
         for assist_message in assistant_messages:
             if assist_message.block_id != last_block:
-                try:
-                    user_action = user_actions[last_block]
-                except IndexError:
+                user_action = actions_by_step.get(last_block)
+                if not user_action:
                     break
                 if user_action.message:
                     chat.append(BlockMessage(
@@ -72,25 +155,44 @@ class OnboardingRepo(Repository):
 
         return chat
 
-    async def get_assistant_message(self, block_id: int | None = None) -> list[AssistantMessage]:
-        a_msgs, messages = [], []
+    async def _load_assistant_messages(self) -> dict[int, list[AssistantMessage]]:
+        cls = OnboardingRepo
+        if cls.assistant_messages is not None and \
+                time.monotonic() - cls.assistant_messages_loaded_at < cls.assistant_messages_ttl:
+            return cls.assistant_messages
 
         async with RedisClient() as client:
             messages = await client.lrange(self.assistant_messages_key, 0, -1)
 
+        blocks = defaultdict(list)
         for message in messages:
-            a_msg = AssistantMessage.parse_raw(message.decode('utf-8'))
-            if block_id is not None and str(a_msg.block_id) != str(block_id):
-                continue
-            a_msgs.append(a_msg)
+            a_msg = AssistantMessage.model_validate_json(message)
+            blocks[a_msg.block_id].append(a_msg)
+
+        cls.assistant_messages = dict(blocks)
+        cls.assistant_messages_loaded_at = time.monotonic()
+        return cls.assistant_messages
 
-        return a_msgs
+    async def get_assistant_message(self, block_id: int | None = None) -> list[AssistantMessage]:
+        blocks = await self._load_assistant_messages()
+
+        if block_id is not None:
+            try:
+                return list(blocks.get(int(block_id), []))
+            except (TypeError, ValueError):
+                return []
+
+        return [a_msg for block in sorted(blocks) for a_msg in blocks[block]]
 
     async def override_assistant_messages(self, new_messages: list[AssistantMessage]) -> None:
         async with RedisClient() as client:
-            await client.delete(self.assistant_messages_key)
-            for new_message in new_messages:
-                await client.rpush(
-                    self.assistant_messages_key,
-                    new_message.model_dump_json()
-                )
+            async with client.pipeline(transaction=True) as pipe:
+                pipe.delete(self.assistant_messages_key)
+                if new_messages:
+                    pipe.rpush(
+                        self.assistant_messages_key,
+                        *[new_message.model_dump_json() for new_message in new_messages]
+                    )
+                await pipe.execute()
+
+        OnboardingRepo.assistant_messages = None
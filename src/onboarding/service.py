@@ -1,6 +1,5 @@
 from typing import Any
-from collections import Counter, defaultdict
-from .models import UserAction, Action, Onboarding, NextAction
+from .models import UserAction, Action, Onboarding, NextAction, OnboardingCursor
 from .repo import OnboardingRepo
 
 
@@ -17,37 +16,19 @@ class Script:
             (Action.CHARGE_PIXEL_LIGHTS, 300),
             (Action.CLEAR_PIXEL_LAYER, 300),
         ]
-        self.counter = Counter([action[0] for action in self.actions])
+        # (шаг, действие) -> следующий шаг, остальные действия на шаге не принимаются
+        self.transitions: dict[tuple[int, Action], int] = {
+            (step, action): step + 1 for step, (action, _) in enumerate(self.actions)
+        }
 
-    async def get_next_action(self, user_id: int, last_action: Action | None) -> NextAction | None:
-        a_msgs, next_action_idx, meta, skiped_actions = (
-            [], 0, None, defaultdict(int)
-        )
-
-        if not last_action:
-            next_action_idx = 0
-        else:
-            for idx, _action in enumerate(self.actions):
-                action, _ = _action
-                skiped_actions[action] += 1
-                if action != last_action:
-                    continue
-
-                if self.counter[action] > 1:
-                    user_actions = len(await self._repo.get_user_actions(user_id, action))
-                    if user_actions == skiped_actions[action]:
-                        next_action_idx = idx + 1
-                        break
-                    else:
-                        continue
-                else:
-                    next_action_idx = idx + 1
-                    break
+    def get_transition(self, step: int, action: Action) -> int | None:
+        return self.transitions.get((step, action))
 
-        a_msgs = await self._repo.get_assistant_message(next_action_idx)
+    async def get_next_action(self, step: int) -> NextAction:
+        a_msgs = await self._repo.get_assistant_message(step)
 
         try:
-            next_action, meta = self.actions[next_action_idx][0], self.actions[next_action_idx][1]
+            next_action, meta = self.actions[step]
         except IndexError:
             next_action, meta = None, None
 
@@ -63,33 +44,22 @@ class OnboardingService:
         self._repo: OnboardingRepo = OnboardingRepo()
         self._script = Script(self._repo)
 
-    async def _get_last_user_action(self, user_id: int) -> UserAction | None:
-        user_actions = await self._repo.get_user_actions(user_id)
-
-        try:
-            return user_actions[-1]
-        except IndexError:
-            return None
-
     async def handle_user_action(self, user_action: UserAction) -> NextAction:
-        last_action = await self._get_last_user_action(user_action.u_id)
-        awaitable_user_action = await self._script.get_next_action(
-            last_action.u_id if last_action else user_action.u_id,
-            last_action.action if last_action else None
-        )
-        if awaitable_user_action.action != user_action.action:
-            return awaitable_user_action
+        cursor = await self._repo.get_cursor(user_action.u_id)
+        if self._script.get_transition(cursor.step, user_action.action) is None:
+            return await self._script.get_next_action(cursor.step)
 
-        await self._repo.save_action(user_action)
+        saved: OnboardingCursor | None = await self._repo.save_action(user_action, cursor.step)
+        if not saved:
+            # шаг уже сдвинут параллельным запросом, отдаем актуальное состояние
+            saved = await self._repo.get_cursor(user_action.u_id)
 
-        return await self._script.get_next_action(user_action.u_id, user_action.action)
+        return await self._script.get_next_action(saved.step)
 
     async def get_onboarding(self, user_id: int) -> Onboarding:
-        last_action = await self._get_last_user_action(user_id)
-
-        next_action = await self._script.get_next_action(user_id, last_action.action if last_action else None)
+        cursor = await self._repo.get_cursor(user_id)
 
         return Onboarding(
             chat=await self._repo.get_chat_history(user_id),
-            next_action=next_action
+            next_action=await self._script.get_next_action(cursor.step)
         )
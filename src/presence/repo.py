@@ -0,0 +1,52 @@
+import time
+import uuid
+from src.pubsub_manager import RedisClient
+from config import settings
+
+
+class PresenceRepo:
+    # zset сокетов пользователя в чате, score - время истечения heartbeat в мс
+    presence_key: str = 'presence_%s:%s'
+
+    def __init__(self, ttl: int = settings.presence_ttl):
+        self.ttl_ms = ttl * 1000
+
+    def get_presence_key(self, user_id: int, chat_id: int) -> str:
+        return self.presence_key % (str(user_id), str(chat_id))
+
+    async def heartbeat(self, user_id: int, chat_id: int, socket_id: str) -> None:
+        await self.heartbeat_many(user_id, {chat_id: socket_id})
+
+    # chats: chat_id -> socket_id
+    async def heartbeat_many(self, user_id: int, chats: dict[int, str]) -> None:
+        if not chats:
+            return
+        now = int(time.time() * 1000)
+
+        async with RedisClient() as r:
+            async with r.pipeline(transaction=False) as pipe:
+                for chat_id, socket_id in chats.items():
+                    key = self.get_presence_key(user_id, chat_id)
+                    pipe.zremrangebyscore(key, '-inf', now)
+                    pipe.zadd(key, {socket_id: now + self.ttl_ms})
+                    pipe.pexpire(key, self.ttl_ms)
+                await pipe.execute()
+
+    async def connect(self, user_id: int, chat_id: int) -> str:
+        socket_id = uuid.uuid4().hex
+        await self.heartbeat(user_id, chat_id, socket_id)
+        return socket_id
+
+    async def disconnect(self, user_id: int, chat_id: int, socket_id: str) -> None:
+        async with RedisClient() as r:
+            await r.zrem(self.get_presence_key(user_id, chat_id), socket_id)
+
+    async def is_connected(self, user_id: int, chat_id: int) -> bool:
+        if not user_id or not chat_id:
+            return False
+
+        async with RedisClient() as r:
+            return await r.zcount(
+                self.get_presence_key(user_id, chat_id),
+                int(time.time() * 1000), '+inf'
+            ) > 0
@@ -1,6 +1,31 @@
+import asyncio
+from collections import defaultdict
+from typing import Any, Callable
 import redis.asyncio as aioredis
+from redis.asyncio.client import Pipeline
+from redis.commands.core import AsyncScript
 from config import settings
 from monitor import Monitor
+from src import metrics
+
+
+# пайплайн считается одним запросом, сколько бы команд в нем ни было
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True):
+        if self.command_stack:
+            metrics.redis_round_trips.labels('multi' if self.is_transaction else 'pipeline').inc()
+        return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(aioredis.Redis):
+    async def execute_command(self, *args, **options):
+        metrics.redis_round_trips.labels(str(args[0]).lower()).inc()
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction: bool = True, shard_hint: str | None = None) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
 
 
 class RedisClient:
@@ -8,11 +33,12 @@ class RedisClient:
         settings.conn_string
     )
     redis_connection = None
+    scripts: dict[str, AsyncScript] = {}
 
     @classmethod
     async def connect(cls):
         if not cls.redis_connection:
-            cls.redis_connection = aioredis.Redis(connection_pool=cls.pool)
+            cls.redis_connection = InstrumentedRedis(connection_pool=cls.pool)
         await Monitor.log("Подключение к Редис открыто")
 
     @classmethod
@@ -23,8 +49,109 @@ class RedisClient:
             await cls.pool.disconnect()
         await Monitor.log("Подключение к Редис закрыто")
 
+    @classmethod
+    def get_script(cls, script: str) -> AsyncScript:
+        if script not in cls.scripts:
+            cls.scripts[script] = cls.redis_connection.register_script(script)
+        return cls.scripts[script]
+
     async def __aenter__(self) -> 'Redis':
         return self.redis_connection
 
     async def __aexit__(self, *args):
         pass
+
+
+# одно pub/sub подключение на процесс, сообщения раздаются по локальным очередям
+class PubSubMultiplexer:
+    LISTEN_TIMEOUT = 1.0
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, decoder: Callable[[bytes], Any] | None = None):
+        self.decoder = decoder
+        self.pubsub = None
+        self.listener: asyncio.Task | None = None
+        self.subscribers: dict[str, set[asyncio.Queue]] = defaultdict(set)
+        self.lock = asyncio.Lock()
+
+    async def subscribe(self, channel: str, queue: asyncio.Queue | None = None) -> asyncio.Queue:
+        if queue is None:
+            queue = asyncio.Queue()
+
+        async with self.lock:
+            if not self.pubsub:
+                async with RedisClient() as r:
+                    self.pubsub = r.pubsub()
+
+            if not self.subscribers[channel]:
+                await self.pubsub.subscribe(channel)
+            self.subscribers[channel].add(queue)
+
+            if not self.listener or self.listener.done():
+                self.listener = asyncio.create_task(self._listen())
+
+        return queue
+
+    async def unsubscribe(self, channel: str, queue: asyncio.Queue) -> None:
+        async with self.lock:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None:
+                return
+
+            subscribers.discard(queue)
+            if subscribers:
+                return
+
+            del self.subscribers[channel]
+            if self.pubsub:
+                await self.pubsub.unsubscribe(channel)
+
+    async def _dispatch(self, channel: str, data: bytes) -> None:
+        subscribers = self.subscribers.get(channel)
+        if not subscribers:
+            return
+
+        # декодируем один раз на процесс, а не на каждый сокет
+        if self.decoder:
+            try:
+                data = self.decoder(data)
+            except Exception as e:
+                Monitor.log_nowait(e, level=Monitor.ERROR)
+                return
+
+        for queue in subscribers:
+            queue.put_nowait(data)
+
+    async def _listen(self) -> None:
+        while self.pubsub:
+            try:
+                message = await self.pubsub.get_message(
+                    ignore_subscribe_messages=True,
+                    timeout=self.LISTEN_TIMEOUT
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                Monitor.log_nowait(e, level=Monitor.ERROR)
+                await asyncio.sleep(self.RECONNECT_DELAY)
+                continue
+
+            if not message or message["type"] != "message":
+                continue
+
+            channel = message["channel"]
+            if isinstance(channel, bytes):
+                channel = channel.decode("utf-8")
+
+            await self._dispatch(channel, message["data"])
+
+    async def close(self) -> None:
+        async with self.lock:
+            if self.listener:
+                self.listener.cancel()
+                self.listener = None
+            if self.pubsub:
+                await self.pubsub.unsubscribe()
+                await self.pubsub.aclose()
+                self.pubsub = None
+            self.subscribers.clear()
@@ -1,23 +1,111 @@
 from typing import TypeVar, Generic, Any, Tuple, Type, Dict
+from collections import defaultdict
 import datetime
 import pytz
 from pydantic import BaseModel
+from pymongo import IndexModel
 from mongo_database import MongoDBClient
+from monitor import Monitor
 
 
 class Repository:
     messages_collection = "messages"
     lights_collection = "lights"
     onboardings_collection = "onboardings"
+    onboarding_cursors_collection = "onboarding_cursors"
+    unread_counters_collection = "unread_counters"
     mongo_client: MongoDBClient = MongoDBClient
 
+    # индексы, которые нужны запросам репозитория: {коллекция: [IndexModel]}
+    indexes: dict[str, list[IndexModel]] = {}
+
+    @classmethod
+    def get_declared_indexes(cls) -> dict[str, list[IndexModel]]:
+        declared = defaultdict(list)
+        repositories = [cls]
+        while repositories:
+            repo = repositories.pop()
+            repositories.extend(repo.__subclasses__())
+            for collection, models in repo.__dict__.get('indexes', {}).items():
+                declared[collection].extend(models)
+        return declared
+
+    # служебные поля index_information(), которые не задаются в IndexModel
+    index_service_fields = {'v', 'ns', 'key', 'name', 'background'}
+    # счетчики $indexStats сбрасываются при рестарте mongod и пересоздании индекса,
+    # по короткой статистике "не используется" ничего не значит
+    unused_index_min_age = datetime.timedelta(days=7)
+
+    @classmethod
+    def _index_diff(cls, model: IndexModel, existing: dict) -> list[str]:
+        declared = model.document
+        diff = []
+        if list(declared['key'].items()) != [tuple(field) for field in existing['key']]:
+            diff.append('key')
+        options = (set(declared) | set(existing)) - cls.index_service_fields
+        diff.extend(
+            option for option in sorted(options)
+            if declared.get(option) != existing.get(option)
+        )
+        return diff
+
     @classmethod
     async def create_indexes(cls):
-        async with cls.mongo_client(cls.lights_collection) as collection:
-            await collection.create_index(
-                [("user_id", 1), ("chat_id", 1)],
-                unique=True
-            )
+        for collection_name, models in cls.get_declared_indexes().items():
+            async with cls.mongo_client(collection_name) as collection:
+                existing = await collection.index_information()
+                missing = []
+                for model in models:
+                    name = model.document['name']
+                    if name not in existing:
+                        missing.append(model)
+                        continue
+                    # индекс с тем же именем, но другим ключом или опциями сам не пересоздается:
+                    # удаление уникального индекса на проде должен делать человек
+                    diff = cls._index_diff(model, existing[name])
+                    if diff:
+                        await Monitor.log(
+                            f"Индекс {collection_name}.{name} отличается от объявленного: "
+                            f"{', '.join(diff)}", unknown=True
+                        )
+
+                if missing:
+                    await collection.create_indexes(missing)
+                    await Monitor.log(
+                        f"Созданы индексы {collection_name}: "
+                        f"{', '.join(model.document['name'] for model in missing)}"
+                    )
+
+                await cls._report_indexes(collection_name, collection, models)
+
+    @classmethod
+    async def _report_indexes(cls, collection_name: str, collection, models: list[IndexModel]) -> None:
+        declared = {model.document['name'] for model in models}
+        try:
+            stats = await collection.aggregate([{"$indexStats": {}}]).to_list(None)
+        except Exception as e:
+            await Monitor.log(str(e), unknown=True)
+            return
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for stat in stats:
+            name = stat['name']
+            if name == '_id_':
+                continue
+            if name not in declared:
+                await Monitor.log(
+                    f"Индекс {collection_name}.{name} не объявлен в репозитории")
+                continue
+
+            accesses = stat.get('accesses', {})
+            since = accesses.get('since')
+            if accesses.get('ops') or not isinstance(since, datetime.datetime):
+                continue
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=datetime.timezone.utc)
+            if now - since >= cls.unused_index_min_age:
+                await Monitor.log(
+                    f"Индекс {collection_name}.{name} не используется с {since.isoformat()}")
 
     @staticmethod
     def get_now() -> datetime.datetime:
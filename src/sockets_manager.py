@@ -1,37 +1,216 @@
 import datetime
 import json
+from dataclasses import dataclass
 from abc import ABC, abstractclassmethod
-from collections import defaultdict
+from collections import defaultdict, deque
 import redis
 from pydantic import ValidationError
 import time
 import websockets.exceptions
 from pydantic import BaseModel
+from pydantic_core import to_json
 from typing import NoReturn, Any, Union
 import asyncio
 import logging
-from fastapi import WebSocket
+import msgpack
+from fastapi import WebSocket, WebSocketDisconnect
 from src import metrics
-from src.pubsub_manager import RedisClient
-from src.messages.model import Message
+from src.pubsub_manager import RedisClient, PubSubMultiplexer
+from src.messages.model import Message, MessageRecord, packb
 from src.messages.service import MessagesService
 from src.messages.repo import MessagesRepo
+from src.messages.writer import MessagesWriter
 from src.lights.model import Light, UsersLayer, LightDTO
 from src.lights.repo import LightsRepo
+from src.notifications.repo import NotificationsRepo
+from src.presence.repo import PresenceRepo
 from config import settings
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.exc import InterfaceError
 from monitor import Monitor
 
 
-class Package(BaseModel):
-    message: Message
-    lights: LightDTO | None
+@dataclass(slots=True)
+class Package:
+    message: MessageRecord
+    lights: LightDTO | None = None
+
+    def to_wire(self) -> dict:
+        return {
+            'message': self.message.to_wire(),
+            'lights': self.lights.model_dump(mode='json') if self.lights else None
+        }
+
+
+JSON_PROTOCOL = 'json'
+MSGPACK_PROTOCOL = 'msgpack'
+
+# начало msgpack-словаря {"message": <сообщение>, "lights": nil} вокруг готовых байт сообщения
+MSGPACK_PACKAGE_HEAD = b'\x82' + msgpack.packb('message')
+MSGPACK_PACKAGE_TAIL = msgpack.packb('lights') + msgpack.packb(None)
+MSGPACK_PING = msgpack.packb('PING')
+MSGPACK_PONG = msgpack.packb('PONG')
+
+
+# бинарный протокол клиент запрашивает через Sec-WebSocket-Protocol, по умолчанию json
+def negotiate_protocol(websocket: WebSocket) -> str:
+    if MSGPACK_PROTOCOL in websocket.scope.get('subprotocols', []):
+        return MSGPACK_PROTOCOL
+    return JSON_PROTOCOL
+
+
+def encode_package(package: Package, protocol: str) -> str | bytes:
+    if protocol == MSGPACK_PROTOCOL:
+        return packb(package.to_wire())
+    return to_json(package.to_wire()).decode('utf-8')
+
+
+def decode_frame(data: str | bytes) -> Any:
+    if isinstance(data, bytes):
+        return msgpack.unpackb(data)
+    return json.loads(data)
+
+
+# PING приходит текстом или msgpack-строкой, PONG уходит кадром того же типа
+def get_pong(data: str | bytes) -> str | bytes | None:
+    if data == 'PING':
+        return 'PONG'
+    if isinstance(data, bytes) and data == MSGPACK_PING:
+        return MSGPACK_PONG
+    return None
+
+
+class Broadcast:
+    __slots__ = ('message', 'payload', 'packages', 'received_at')
+
+    def __init__(self, message: MessageRecord, payload: bytes | None = None):
+        self.message = message
+        # момент получения из pub/sub, от него считается fanout
+        self.received_at = time.perf_counter()
+        # msgpack-байты сообщения из publish, пересылаются без перекодирования
+        self.payload = payload
+        self.packages: dict[str, str | bytes] = {}
+
+    # пакет для всех получателей, кроме отправителя, рендерится один раз на протокол
+    def render(self, protocol: str) -> str | bytes:
+        package = self.packages.get(protocol)
+        if package is not None:
+            return package
+
+        if protocol == MSGPACK_PROTOCOL:
+            if self.payload is None:
+                self.payload = self.message.msgpack_dumps()
+            package = MSGPACK_PACKAGE_HEAD + self.payload + MSGPACK_PACKAGE_TAIL
+        else:
+            package = encode_package(Package(self.message), protocol)
+
+        self.packages[protocol] = package
+        return package
+
+    # json из старых publish начинается с '{', msgpack-словарь с 0x80..0x8f / 0xde / 0xdf
+    @classmethod
+    def from_payload(cls, payload: bytes) -> 'Broadcast':
+        if payload[:1] == b'{':
+            return cls(MessageRecord.from_model(Message.json_loads(payload)))
+        return cls(MessageRecord.msgpack_loads(payload), payload)
+
+
+class SendQueueOverflow(Exception):
+    pass
+
+
+# ограниченная очередь отправки в сокет, медленный клиент не копит память воркера
+class SendQueue:
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+    DISCONNECT = 'disconnect'
+
+    def __init__(self, user_id: int, maxsize: int = settings.ws_send_queue_size,
+                 policy: str = settings.ws_send_queue_policy):
+        self.user_id = int(user_id)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.frames: deque[Broadcast] = deque()
+        self.event = asyncio.Event()
+        self.overflowed = False
+
+    def qsize(self) -> int:
+        return len(self.frames)
+
+    # свои сообщения сбрасываются последними, на них начисляются огоньки
+    def _is_own(self, broadcast: Broadcast) -> bool:
+        return int(broadcast.message.user_id) == self.user_id
+
+    def _drop_oldest(self) -> int:
+        for i, frame in enumerate(self.frames):
+            if not self._is_own(frame):
+                del self.frames[i]
+                return 1
+        return 0
+
+    # в очереди остается только последний кадр чата
+    def _coalesce(self, broadcast: Broadcast) -> int:
+        chat_id = broadcast.message.chat_id
+        size = len(self.frames)
+        self.frames = deque(
+            frame for frame in self.frames
+            if self._is_own(frame) or frame.message.chat_id != chat_id
+        )
+        dropped = size - len(self.frames)
+        return dropped or self._drop_oldest()
+
+    def put_nowait(self, broadcast: Broadcast) -> None:
+        if self.overflowed:
+            return
+
+        if len(self.frames) >= self.maxsize:
+            if self.policy == self.DISCONNECT:
+                metrics.ws_send_queue_drops.labels(self.policy).inc(len(self.frames) + 1)
+                metrics.ws_send_queue_overflows.inc()
+                self.frames.clear()
+                self.overflowed = True
+                self.event.set()
+                return
+
+            if self.policy == self.COALESCE:
+                dropped = self._coalesce(broadcast)
+            else:
+                dropped = self._drop_oldest()
+
+            if not dropped:
+                # очередь забита собственными сообщениями: размер ограничен и для них
+                self.frames.popleft()
+                dropped = 1
+            metrics.ws_send_queue_drops.labels(self.policy).inc(dropped)
+
+        self.frames.append(broadcast)
+        metrics.ws_send_queue_depth.observe(len(self.frames))
+        self.event.set()
+
+    async def get(self) -> Broadcast:
+        while not self.frames:
+            if self.overflowed:
+                raise SendQueueOverflow()
+            self.event.clear()
+            await self.event.wait()
+        return self.frames.popleft()
+
+
+class UserSession:
+    def __init__(self, websocket: WebSocket, user_id: int, layer: int, protocol: str = JSON_PROTOCOL):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.layer = layer
+        self.protocol = protocol
+        self.queue = SendQueue(user_id)
+        # chat_id -> (recipient_id, socket_id)
+        self.chats: dict[int, tuple[int, str]] = {}
 
 
 class WebSocketBroadcaster(ABC):
     messages_repo = MessagesRepo()
     lights_repo = LightsRepo()
+    multiplexer = PubSubMultiplexer(decoder=Broadcast.from_payload)
 
     STREAM_NAME = 'channel_%s_messages'
     MAX_STREAM_LEN = 100
@@ -39,6 +218,10 @@ class WebSocketBroadcaster(ABC):
     CHANNEL_NAME = 'channel_%s'
     NOTIFICATIONS_STREAM = 'notifications'
 
+    notifications_repo = NotificationsRepo()
+    presence_repo = PresenceRepo()
+    writer = MessagesWriter(messages_repo, CHANNEL_NAME, notifications_repo)
+
     async def _create_group(self, chat_id: int, user_id):
         async with RedisClient() as r:
             try:
@@ -47,25 +230,21 @@ class WebSocketBroadcaster(ABC):
                 if "BUSYGROUP Consumer Group name already exists" in str(e):
                     pass
 
-    async def handle_message(self, message: Message, layer: int) -> Package:
+    async def handle_message(self, message: MessageRecord, layer: int) -> Package:
         prev_message = await self.messages_repo.get_last_chat_message(message.chat_id)
 
         if not prev_message:
             prev_message = message
         await self.messages_repo.store_last_chat_message(message.chat_id, message)
 
-        if message and message.created_at and prev_message and prev_message.created_at:
-            time_diff = (message.created_at -
-                         prev_message.created_at).total_seconds()
-        else:
-            time_diff = 0
-
-        if not message or not message.user_id or not prev_message or not prev_message.user_id:
+        # отправитель в чате, так как сообщение пришло из его сокета
+        if not message or not message.user_id or not message.recipient_id:
             are_both_online = False
-        elif time_diff <= 15 and message.user_id != prev_message.user_id:
-            are_both_online = True
-        else:
+        elif message.user_id == message.recipient_id:
             are_both_online = False
+        else:
+            are_both_online = await self.presence_repo.is_connected(
+                message.recipient_id, message.chat_id)
 
         light = Light(user_id=message.user_id,
                       chat_id=message.chat_id,
@@ -74,113 +253,213 @@ class WebSocketBroadcaster(ABC):
                       are_both_online=are_both_online,
                       users_layer=layer)
 
-        await self.lights_repo.save_up(light.to_dto())
+        lights = light.to_dto()
+        await self.lights_repo.save_up(lights)
 
-        package = Package(
-            message=message,
-            lights=light.to_dto() if light.amount else None
-        )
+        return Package(message, lights if light.amount else None)
 
-        return package
+    @abstractclassmethod
+    async def chat_ws_receiver(self, websocket: WebSocket, chat_id: int, user_id: int, recipient_id: int, layer: int, reply_id: int | None, socket_id: str | None = None):
+        raise NotImplementedError()
 
     @abstractclassmethod
-    async def chat_ws_receiver(self, websocket: WebSocket, chat_id: int, user_id: int, recipient_id: int, layer: int, reply_id: int | None):
+    async def chat_ws_sender(self, websocket: WebSocket, chat_id: int, layer: int, user_id: int, recipient_id: int, protocol: str = JSON_PROTOCOL):
         raise NotImplementedError()
 
     @abstractclassmethod
-    async def chat_ws_sender(self, websocket: WebSocket, chat_id: int, layer: int, user_id: int, recipient_id: int):
+    async def user_ws_receiver(self, session: UserSession):
         raise NotImplementedError()
 
+    @abstractclassmethod
+    async def user_ws_sender(self, session: UserSession):
+        raise NotImplementedError()
 
-class PubSubBroadcaster(WebSocketBroadcaster):
-    async def chat_ws_receiver(self, websocket: WebSocket, chat_id: int, user_id: int, recipient_id: int, layer: int, reply_id: int | None):
-        channel_name = self.CHANNEL_NAME % str(chat_id)
+    @abstractclassmethod
+    async def close_session(self, session: UserSession):
+        raise NotImplementedError()
 
-        async for data in websocket.iter_text():
-            try:
-                encoded_data = json.loads(data)
-                data, sent_at = encoded_data.get(
-                    'message', ""), encoded_data.get('sent_at')
-            except (json.JSONDecodeError, ValueError):
-                sent_at = None
 
-            if len(data) == 0:
-                continue
-            if data == 'PING':
+class PubSubBroadcaster(WebSocketBroadcaster):
+    async def _send(self, websocket: WebSocket, payload: str | bytes) -> None:
+        try:
+            if isinstance(payload, bytes):
+                await websocket.send_bytes(payload)
+            else:
+                await websocket.send_text(payload)
+        except websockets.exceptions.ConnectionClosedOK:
+            Monitor.log_nowait("Клиент разорвал соединение")
+
+    async def _close_overflowed(self, websocket: WebSocket) -> None:
+        Monitor.log_nowait("Клиент не успевает читать, соединение закрыто")
+        try:
+            await websocket.close(code=settings.ws_send_queue_close_code)
+        except (RuntimeError, websockets.exceptions.ConnectionClosed):
+            pass
+
+    async def _render(self, broadcast: Broadcast, user_id: int, layer: int, protocol: str = JSON_PROTOCOL) -> str | bytes:
+        try:
+            if int(user_id) != int(broadcast.message.user_id):
+                return broadcast.render(protocol)
+            start = time.perf_counter()
+            package = await self.handle_message(broadcast.message, layer)
+            metrics.message_stage_latency.labels('handle_message').observe(
+                time.perf_counter() - start)
+            return encode_package(package, protocol)
+        except asyncio.exceptions.CancelledError as e:
+            return broadcast.render(protocol)
+
+    async def _send_broadcast(self, websocket: WebSocket, broadcast: Broadcast, user_id: int,
+                              layer: int, protocol: str) -> None:
+        start = time.perf_counter()
+        await self._send(websocket, await self._render(broadcast, user_id, layer, protocol))
+
+        now = time.perf_counter()
+        metrics.ws_time_to_process.observe(now - start)
+        metrics.message_stage_latency.labels('fanout').observe(now - broadcast.received_at)
+
+        # sent_at задают часы клиента, отрицательную задержку из-за рассинхрона не учитываем
+        sent_at = broadcast.message.sent_at
+        if sent_at and int(user_id) != int(broadcast.message.user_id):
+            latency = time.time() - sent_at.timestamp()
+            if latency >= 0:
+                metrics.message_e2e_latency.observe(latency)
+
+    # текстовые кадры json-клиентов и бинарные кадры msgpack-клиентов
+    async def _iter_frames(self, websocket: WebSocket):
+        try:
+            while True:
+                frame = await websocket.receive()
+                if frame['type'] == 'websocket.disconnect':
+                    return
+                if frame.get('text') is not None:
+                    yield frame['text']
+                elif frame.get('bytes') is not None:
+                    yield frame['bytes']
+        except WebSocketDisconnect:
+            return
+
+    async def _receive_message(self, user_id: int, chat_id: int, recipient_id: int, text: str,
+                               reply_id: int | None, sent_at: Any) -> None:
+        try:
+            message = MessageRecord.create(
+                user_id, chat_id, text, recipient_id, reply_id, sent_at)
+        except (ValueError, TypeError, OverflowError):
+            return
+
+        # запись в монгу, флаг новых сообщений, publish и xadd идут пачкой
+        start = time.perf_counter()
+        await self.writer.write(message)
+        metrics.message_stage_latency.labels('receive').observe(time.perf_counter() - start)
+
+        metrics.ws_messages.inc()
+        metrics.ws_bytes_in.inc(amount=int(len(text)))
+
+    async def chat_ws_receiver(self, websocket: WebSocket, chat_id: int, user_id: int, recipient_id: int, layer: int, reply_id: int | None, socket_id: str | None = None):
+        async for data in self._iter_frames(websocket):
+            pong = get_pong(data)
+            if not pong:
                 try:
-                    await websocket.send_text('PONG')
-                except websockets.exceptions.ConnectionClosedOK:
-                    await Monitor.log("Клиент разорвал соединение")
-                continue
-
-            try:
-                message = Message(
-                    user_id=user_id,
-                    chat_id=chat_id,
-                    text=data,
-                    reply_id=reply_id,
-                    is_read=False,
-                    is_edited=False,
-                    recipient_id=recipient_id,
-                    sent_at=sent_at
-                )
-            except ValidationError:
-                continue
+                    encoded_data = decode_frame(data)
+                    data, sent_at = encoded_data.get(
+                        'message', ""), encoded_data.get('sent_at')
+                except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+                    sent_at = None
+                    if isinstance(data, bytes):
+                        continue
 
-            message = await self.messages_repo.add_message(message)
-            await self.messages_repo.update_has_new_messages(
-                recipient_id,
-                chat_id,
-                True
-            )
+                if len(data) == 0:
+                    continue
+                pong = get_pong(data)
 
-            async with RedisClient() as r:
-                await r.publish(channel_name, message.json_dumps())
-                await r.xadd(self.NOTIFICATIONS_STREAM, message.serialize())
+            if pong:
+                if socket_id:
+                    await self.presence_repo.heartbeat(user_id, chat_id, socket_id)
+                await self._send(websocket, pong)
+                continue
 
-            metrics.ws_messages.inc()
-            metrics.ws_bytes_in.inc(amount=int(len(data)))
+            await self._receive_message(user_id, chat_id, recipient_id, data, reply_id, sent_at)
 
-    async def chat_ws_sender(self, websocket: WebSocket, chat_id: int, layer: int, user_id: int, recipient_id: int):
+    async def chat_ws_sender(self, websocket: WebSocket, chat_id: int, layer: int, user_id: int, recipient_id: int, protocol: str = JSON_PROTOCOL):
         channel_name = self.CHANNEL_NAME % str(chat_id)
 
-        async with RedisClient() as r:
-            pubsub = r.pubsub()
-            await pubsub.subscribe(channel_name)
+        queue = await self.multiplexer.subscribe(channel_name, SendQueue(user_id))
+        try:
+            while True:
+                try:
+                    broadcast: Broadcast = await queue.get()
+                except SendQueueOverflow:
+                    await self._close_overflowed(websocket)
+                    return
+                await self._send_broadcast(websocket, broadcast, user_id, layer, protocol)
+        finally:
+            await self.multiplexer.unsubscribe(channel_name, queue)
+
+    async def subscribe_chat(self, session: UserSession, chat_id: int, recipient_id: int) -> None:
+        if chat_id in session.chats:
+            return
+
+        socket_id = await self.presence_repo.connect(session.user_id, chat_id)
+        session.chats[chat_id] = (recipient_id, socket_id)
+        await self.multiplexer.subscribe(self.CHANNEL_NAME % str(chat_id), session.queue)
+
+    async def unsubscribe_chat(self, session: UserSession, chat_id: int) -> None:
+        if chat_id not in session.chats:
+            return
+
+        _, socket_id = session.chats.pop(chat_id)
+        await self.multiplexer.unsubscribe(self.CHANNEL_NAME % str(chat_id), session.queue)
+        await self.presence_repo.disconnect(session.user_id, chat_id, socket_id)
+
+    async def close_session(self, session: UserSession) -> None:
+        for chat_id in list(session.chats):
+            await self.unsubscribe_chat(session, chat_id)
+
+    # кадры клиента: PING или json с action subscribe / unsubscribe / message и chat_id
+    async def user_ws_receiver(self, session: UserSession):
+        async for data in self._iter_frames(session.websocket):
+            pong = get_pong(data)
+            if pong:
+                await self.presence_repo.heartbeat_many(session.user_id, {
+                    chat_id: socket_id for chat_id, (_, socket_id) in session.chats.items()
+                })
+                await self._send(session.websocket, pong)
+                continue
+
             try:
-                async for message in pubsub.listen():
-                    start = time.time()
+                frame = decode_frame(data)
+                action, chat_id = frame.get('action'), int(frame.get('chat_id'))
+            except (json.JSONDecodeError, ValueError, TypeError, AttributeError):
+                continue
 
-                    if message["type"] != "message":
-                        continue
+            if action == 'subscribe':
+                try:
+                    recipient_id = int(frame.get('recipient_id'))
+                except (ValueError, TypeError):
+                    continue
+                await self.subscribe_chat(session, chat_id, recipient_id)
+            elif action == 'unsubscribe':
+                await self.unsubscribe_chat(session, chat_id)
+            elif action == 'message' and chat_id in session.chats:
+                text = frame.get('message', "")
+                if not text:
+                    continue
+                await self._receive_message(
+                    session.user_id, chat_id, session.chats[chat_id][0],
+                    text, frame.get('reply_id'), frame.get('sent_at')
+                )
 
-                    message = Message.json_loads(message['data'])
-
-                    try:
-                        if int(user_id) != int(message.user_id):
-                            package = Package(
-                                message=message,
-                                lights=None
-                            )
-                        else:
-                            package = await self.handle_message(message, layer)
-                    except asyncio.exceptions.CancelledError as e:
-                        package = Package(
-                            message=message,
-                            lights=None
-                        )
-
-                    try:
-                        await websocket.send_text(package.model_dump_json())
-                    except websockets.exceptions.ConnectionClosedOK:
-                        await Monitor.log(
-                            "Клиент разорвал соединение")
-
-                    metrics.ws_time_to_process.observe(
-                        (time.time() - start) * 1000)
-            finally:
-                await pubsub.unsubscribe(channel_name)
-                await pubsub.close()
+    async def user_ws_sender(self, session: UserSession):
+        while True:
+            try:
+                broadcast: Broadcast = await session.queue.get()
+            except SendQueueOverflow:
+                await self._close_overflowed(session.websocket)
+                return
+            # сообщения чата, от которого клиент уже отписался, пропускаем
+            if broadcast.message.chat_id not in session.chats:
+                continue
+            await self._send_broadcast(session.websocket, broadcast, session.user_id,
+                                       session.layer, session.protocol)
 
 
 def get_broadcaster(broadcast_backend: str) -> WebSocketBroadcaster: